@@ -22,10 +22,10 @@ A sane default configuration is attainable through nothing more than instantiati
 appropriate classes. `DebianPackage` objects provide information about the architecture, version,
 name, and status of a package.
 
-`DebianPackage` will try to look up a package either from `dpkg -L` or from `apt-cache` when
-provided with a string indicating the package name. If it cannot be located, `PackageNotFoundError`
-will be returned, as `apt` and `dpkg` otherwise return `100` for all errors, and a meaningful error
-message if the package is not known is desirable.
+`DebianPackage` will try to look up a package either from the dpkg status database or from
+`apt-cache` when provided with a string indicating the package name. If it cannot be located,
+`PackageNotFoundError` will be returned, as `apt` and `dpkg` otherwise return `100` for all errors,
+and a meaningful error message if the package is not known is desirable.
 
 To install packages with convenience methods:
 
@@ -61,6 +61,15 @@ except PackageError as e:
     logger.error("could not install package. Reason: %s", e.message)
 ```
 
+To check which packages changed, for instance since an earlier point in a hook:
+
+```python
+before = apt.inventory()
+apt.add_package(["lldpd", "ethtool"])
+changes = before.diff(apt.inventory())
+if "lldpd" in changes:
+    logger.info("lldpd is now at version %s", apt.inventory()["lldpd"].fullversion)
+```
 
 `RepositoryMapping` will return a dict-like object containing enabled system repositories
 and their properties (available groups, baseuri. gpg key). This class can add, disable, or
@@ -71,7 +80,8 @@ be added to `RepositoryMapping`
 
 `RepositoryMapping` provides an abstraction around the existing repositories on the system,
 and can be accessed and iterated over like any `Mapping` object, to retrieve values by key,
-iterate, or perform other operations.
+iterate, or perform other operations. Both one-line `.list` files and deb822 `.sources`
+files are read, when the mapping is first accessed.
 
 Keys are constructed as `{repo_type}-{}-{release}` in order to uniquely identify a repository.
 
@@ -100,18 +110,53 @@ if "deb-us.archive.ubuntu.com-xenial" not in repositories:
     repo = DebianRepository.from_repo_line(line)
     repositories.add(repo)
 ```
+
+Several changes can be applied together, writing each file once and refreshing the indexes
+of the added repositories with a single `apt-get update`:
+
+```python
+repositories = apt.RepositoryMapping()
+
+with repositories.transaction() as txn:
+    txn.add(DebianRepository.from_repo_line(line, write_file=False))
+    txn.disable(repositories["deb-us.archive.ubuntu.com-xenial"])
+```
 """
 
-import fileinput
+import base64
+import contextlib
+import functools
 import glob
+import hashlib
+import itertools
+import json
 import logging
+import mmap
 import os
 import re
+import shutil
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
 from collections.abc import Mapping
 from enum import Enum
-from subprocess import PIPE, CalledProcessError, check_call, check_output
-from typing import Iterable, List, Optional, Tuple, Union
+from subprocess import PIPE, STDOUT, CalledProcessError, check_output
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
@@ -124,12 +169,54 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 7
+LIBPATCH = 26
 
 
 VALID_SOURCE_TYPES = ("deb", "deb-src")
 OPTIONS_MATCHER = re.compile(r"\[.*?\]")
 
+DPKG_STATUS_FILE = "/var/lib/dpkg/status"
+DPKG_UPDATES_DIR = "/var/lib/dpkg/updates"
+# Fields are matched only at the start of a line, continuation lines start with whitespace.
+DPKG_STATUS_MATCHER = re.compile(
+    r"^(Package|Status|Architecture|Version):[ \t]*([^\n]*)", re.MULTILINE
+)
+APT_LISTS_DIR = "/var/lib/apt/lists"
+# Characters escaped in the names of the lists, besides spaces and non-ASCII ones
+APT_LIST_QUOTED = set('\\|{}[]<>"^~_=!@#$%&*')
+APT_SOURCES_LIST = "/etc/apt/sources.list"
+APT_SOURCES_PARTS = "/etc/apt/sources.list.d"
+TRUSTED_GPG_DIR = "/etc/apt/trusted.gpg.d"
+# Keys imported by `import_keys`, so that importing them again needs neither gpg nor writes.
+GPG_KEY_INDEX = "/var/lib/apt/gpg-key-index.json"
+# Repository files parsed by `RepositoryMapping`, so that later hooks only need to stat them.
+SOURCES_CACHE = "/var/lib/apt/charm-sources-cache.json"
+APT_UPDATE_STAMP = "/var/lib/apt/periodic/update-success-stamp"
+# Anchored on the preceding newline rather than `^` so the scan can use a fast literal search.
+PACKAGES_INDEX_MATCHER = re.compile(rb"\nPackage:[ \t]*(\S+)")
+
+# Locks taken by apt and dpkg while changing the installed packages, and while updating.
+DPKG_LOCK_FILES = (
+    "/var/lib/dpkg/lock-frontend",
+    "/var/lib/dpkg/lock",
+    "/var/cache/apt/archives/lock",
+)
+APT_LISTS_LOCK_FILES = ("/var/lib/apt/lists/lock",)
+APT_LOCK_ERROR_MATCHER = re.compile(
+    r"Could not get lock|Unable to acquire the dpkg frontend lock|Unable to lock"
+)
+# Seconds to wait for another process to release the apt and dpkg locks.
+LOCK_TIMEOUT = 300
+LOCK_MAX_BACKOFF = 10
+# Machine readable progress written by apt to the file descriptor given in `APT::Status-Fd`,
+# e.g. "pmstatus:lldpd:42.8571:Installing lldpd (amd64)"
+APT_STATUS_MATCHER = re.compile(r"^(?:pm|dl)status:[^:]*:([0-9.]+):(.*)$")
+APT_FETCH_MATCHER = re.compile(r"^Get:\d+\s+(.*?)(?:\s+\[[^\]]*\])?$")
+# Number of output lines kept for error messages.
+APT_OUTPUT_TAIL = 20
+# Minimum number of seconds between two progress reports.
+PROGRESS_INTERVAL = 2
+
 
 class Error(Exception):
     """Base class of most errors raised by this library."""
@@ -166,6 +253,532 @@ class PackageState(Enum):
     Available = "available"
 
 
+def _parse_stanzas(text: str) -> Iterable[Tuple[str, str, str, str]]:
+    """Yield (name, status, arch, version) for each stanza of a dpkg or apt control file."""
+    stanzas: List[Dict[str, str]] = []
+    for match in DPKG_STATUS_MATCHER.finditer(text):
+        key, value = match.groups()
+        # `Package` always comes first, so it marks the start of a new stanza
+        if key == "Package":
+            stanzas.append({})
+        if stanzas:
+            stanzas[-1][key] = value.strip()
+    for fields in stanzas:
+        yield (
+            fields["Package"],
+            fields.get("Status", ""),
+            fields.get("Architecture", ""),
+            fields.get("Version", ""),
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_system_arch() -> str:
+    """Return the native dpkg architecture, queried once per process."""
+    return check_output(["dpkg", "--print-architecture"], universal_newlines=True).strip()
+
+
+class InstalledPackage(NamedTuple):
+    """A compact record of an installed package, as found in the dpkg database."""
+
+    name: str
+    arch: str
+    epoch: str
+    version: str
+    state: str
+
+    @property
+    def fullversion(self) -> str:
+        """Returns the version, prefixed with the epoch if there is one."""
+        return "{}:{}".format(self.epoch, self.version) if self.epoch else self.version
+
+
+class InventoryDiff:
+    """The names of the packages which differ between two `PackageInventory` snapshots."""
+
+    __slots__ = ("added", "removed", "changed")
+
+    def __init__(self, added: FrozenSet[str], removed: FrozenSet[str], changed: FrozenSet[str]):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __repr__(self):
+        """A representation of the differences."""
+        return "<{}.{}: added={} removed={} changed={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            sorted(self.added),
+            sorted(self.removed),
+            sorted(self.changed),
+        )
+
+    def __bool__(self) -> bool:
+        """Whether anything differs."""
+        return bool(self.added or self.removed or self.changed)
+
+    def __contains__(self, name: str) -> bool:
+        """Whether a given package was added, removed or changed."""
+        return name in self.added or name in self.removed or name in self.changed
+
+
+class PackageInventory(Mapping):
+    """An immutable snapshot of every package installed on the system.
+
+    Packages are keyed by name, or by `name:arch` for packages of a foreign architecture,
+    the way `dpkg -l` displays them.
+
+    Typical usage:
+
+        before = apt.inventory()
+        ...
+        changes = before.diff(apt.inventory())
+        if "lldpd" in changes:
+            ...
+    """
+
+    __slots__ = ("_packages", "_arch")
+
+    def __init__(self, packages: Iterable[InstalledPackage], arch: str):
+        self._arch = arch
+        self._packages: Dict[str, InstalledPackage] = {}
+        for pkg in packages:
+            key = pkg.name if pkg.arch in (arch, "all") else "{}:{}".format(pkg.name, pkg.arch)
+            self._packages[key] = pkg
+
+    def __repr__(self):
+        """A representation of the inventory."""
+        return "<{}.{}: {} packages>".format(self.__module__, self.__class__.__name__, len(self))
+
+    def __getitem__(self, name: str) -> InstalledPackage:
+        """Return the record of an installed package."""
+        return self._packages[name]
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the package names."""
+        return iter(self._packages)
+
+    def __len__(self) -> int:
+        """Return the number of installed packages."""
+        return len(self._packages)
+
+    @property
+    def arch(self) -> str:
+        """Returns the native architecture of the system."""
+        return self._arch
+
+    def lookup(self, name: str, arch: Optional[str] = "") -> List[InstalledPackage]:
+        """Return the records of a package installed for the given or the native architecture.
+
+        Args:
+            name: the name of the package
+            arch: an optional architecture, defaulting to the native one
+        """
+        keys = [name]
+        if arch and arch != self._arch:
+            keys.append("{}:{}".format(name, arch))
+        return [self._packages[k] for k in keys if k in self._packages]
+
+    def diff(self, other: "PackageInventory") -> InventoryDiff:
+        """Compare this snapshot with a later one.
+
+        Args:
+            other: a later `PackageInventory`
+        """
+        mine, theirs = self._packages.keys(), other._packages.keys()
+        return InventoryDiff(
+            added=frozenset(theirs - mine),
+            removed=frozenset(mine - theirs),
+            changed=frozenset(k for k in mine & theirs if self[k] != other[k]),
+        )
+
+
+class _DpkgStatus:
+    """Installed packages read from the dpkg status database.
+
+    The status file and the pending `updates` journal are parsed in one pass, and the result
+    is kept until either of them changes on disk, so repeated lookups cost a couple of `stat`
+    calls and no subprocesses.
+    """
+
+    def __init__(
+        self, status_file: str = DPKG_STATUS_FILE, updates_dir: str = DPKG_UPDATES_DIR
+    ) -> None:
+        self._status_file = status_file
+        self._updates_dir = updates_dir
+        self._stamp = None
+        self._inventory: Optional[PackageInventory] = None
+
+    def _get_stamp(self) -> Tuple:
+        stamp = []
+        for path in (self._status_file, self._updates_dir):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        return tuple(stamp)
+
+    def _journal_files(self) -> List[str]:
+        """Return pending dpkg journal entries, in the order dpkg applies them."""
+        try:
+            names = os.listdir(self._updates_dir)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self._updates_dir, n) for n in sorted(names) if n.isdigit()]
+
+    def _load(self) -> PackageInventory:
+        entries = {}
+        for path in [self._status_file, *self._journal_files()]:
+            try:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            except FileNotFoundError:
+                continue
+            for name, status, arch, version in _parse_stanzas(text):
+                # later entries (the journal) supersede the status file
+                entries[(name, arch)] = (status, version)
+
+        packages = []
+        intern = sys.intern
+        for (name, arch), (status, version) in entries.items():
+            # "install ok installed", "hold ok installed", ... but not "config-files" and friends
+            if status.rsplit(" ", 1)[-1] != "installed":
+                continue
+            epoch, version = DebianPackage._get_epoch_from_version(version)
+            packages.append(
+                InstalledPackage(
+                    intern(name),
+                    intern(arch),
+                    intern(epoch or ""),
+                    intern(version),
+                    intern(status),
+                )
+            )
+        return PackageInventory(packages, _get_system_arch())
+
+    def inventory(self) -> PackageInventory:
+        """Return a snapshot of the installed packages, reparsed only when dpkg changed it."""
+        stamp = self._get_stamp()
+        if self._inventory is None or stamp != self._stamp:
+            self._inventory = self._load()
+            self._stamp = stamp
+        return self._inventory
+
+
+_dpkg_status = _DpkgStatus()
+
+
+def inventory() -> PackageInventory:
+    """Return an immutable snapshot of every installed package.
+
+    The dpkg database is read at most once per change, so this is cheap to call repeatedly.
+    """
+    return _dpkg_status.inventory()
+
+
+class _PackagesIndex:
+    """A memory-mapped apt `Packages` list with a name to stanza offset index.
+
+    The index is built with a single scan of the mapping and kept until the file changes on
+    disk. Only the stanzas of a requested package are ever decoded.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._stamp = None
+        self._mmap: Optional[mmap.mmap] = None
+        # a single offset for most packages, a tuple when several versions are listed
+        self._offsets: Dict[bytes, Union[int, Tuple[int, ...]]] = {}
+
+    def _refresh(self) -> None:
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp == self._stamp:
+            return
+
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap, self._offsets = None, {}
+        self._stamp = stamp
+        if not st.st_size:
+            return
+
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = self._offsets
+        entries = (
+            (m.group(1), m.start() + 1) for m in PACKAGES_INDEX_MATCHER.finditer(self._mmap)
+        )
+        head = PACKAGES_INDEX_MATCHER.match(b"\n" + self._mmap[:256])
+        if head is not None:
+            # the first stanza has no preceding newline
+            entries = itertools.chain([(head.group(1), 0)], entries)
+        for name, offset in entries:
+            known = offsets.get(name)
+            if known is None:
+                offsets[name] = offset
+            elif isinstance(known, int):
+                offsets[name] = (known, offset)
+            else:
+                offsets[name] = known + (offset,)
+
+    def lookup(self, package: str) -> List[Tuple[str, str]]:
+        """Return the (arch, version) pairs listed for a package.
+
+        Args:
+            package: the name of the package
+        """
+        self._refresh()
+        offsets = self._offsets.get(package.encode("utf-8"))
+        if offsets is None:
+            return []
+
+        found = []
+        for offset in (offsets,) if isinstance(offsets, int) else offsets:
+            end = self._mmap.find(b"\n\n", offset)
+            stanza = self._mmap[offset : end if end != -1 else len(self._mmap)]
+            for _, _, arch, version in _parse_stanzas(stanza.decode("utf-8", "replace")):
+                found.append((arch, version))
+        return found
+
+
+def _list_prefix(uri: str, release: str) -> str:
+    """Return the prefix of the names apt gives to the lists of a source.
+
+    This follows `URItoFileName` in apt: the scheme and credentials are dropped, a few
+    characters are escaped, and slashes become underscores.
+    """
+    parsed = urlparse(uri)
+    location = parsed.netloc.rpartition("@")[2] + parsed.path.rstrip("/") + "/"
+    if release.endswith("/"):
+        # a flat repository, its lists are not under dists/
+        location += release
+    else:
+        location += "dists/{}/".format(release)
+    quoted = "".join(
+        "%{:02x}".format(b) if chr(b) in APT_LIST_QUOTED or not 0x20 < b < 0x7F else chr(b)
+        for b in location.encode("utf-8")
+    )
+    return quoted.replace("/", "_")
+
+
+def _configured_list_prefixes() -> List[str]:
+    """Return the prefixes of the names of the lists of the enabled binary sources."""
+    # iterating over the mapping yields the repositories themselves, not their identifiers
+    return [
+        _list_prefix(repo.uri, repo.release)
+        for repo in RepositoryMapping()
+        if repo.enabled and repo.repotype == "deb"
+    ]
+
+
+class _AptLists:
+    """Package availability read from the apt lists, without running `apt-cache`.
+
+    Only the lists of configured sources are read: those of a removed source stay on disk
+    until the next full `apt-get update`, and apt could not install their packages.
+    """
+
+    def __init__(
+        self,
+        lists_dir: str = APT_LISTS_DIR,
+        prefixes: Callable[[], Iterable[str]] = _configured_list_prefixes,
+    ) -> None:
+        self._lists_dir = lists_dir
+        self._prefixes = prefixes
+        self._indexes: Dict[str, _PackagesIndex] = {}
+
+    def lookup(self, package: str) -> Optional[List[Tuple[str, str]]]:
+        """Return the (arch, version) pairs known to apt for a package.
+
+        Returns None when no uncompressed lists of configured sources are available (for
+        instance with `Acquire::GzipIndexes`), in which case the caller should ask
+        `apt-cache` instead.
+
+        Args:
+            package: the name of the package
+        """
+        prefixes = tuple(self._prefixes())
+        paths = [
+            p
+            for p in glob.glob(os.path.join(self._lists_dir, "*_Packages"))
+            if os.path.basename(p).startswith(prefixes)
+        ]
+        if not paths:
+            return None
+
+        self._indexes = {p: self._indexes.get(p) or _PackagesIndex(p) for p in paths}
+        found = []
+        for index in self._indexes.values():
+            try:
+                found.extend(index.lookup(package))
+            except FileNotFoundError:
+                # removed by a concurrent `apt-get update`
+                continue
+        return found
+
+
+_apt_lists = _AptLists()
+
+_update_lock = threading.Lock()
+# monotonic start time of the last successful `apt-get update` run by this process
+_last_update_started: Optional[float] = None
+
+
+def _lock_holder(lock_files: Iterable[str]) -> Optional[Tuple[int, str]]:
+    """Return the pid and name of a process holding one of `lock_files`, if it can be found.
+
+    The holder is looked up in `/proc/locks`, matching the device and inode of each file.
+    """
+    wanted = set()
+    for path in lock_files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        wanted.add((os.major(st.st_dev), os.minor(st.st_dev), st.st_ino))
+    if not wanted:
+        return None
+
+    try:
+        with open("/proc/locks") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        # e.g. "1: POSIX  ADVISORY  WRITE 1234 fd:01:262 0 EOF", waiters are marked with "->"
+        fields = line.split()
+        if len(fields) < 6 or fields[1] == "->":
+            continue
+        try:
+            pid = int(fields[4])
+            major, minor, inode = fields[5].split(":")
+            key = (int(major, 16), int(minor, 16), int(inode))
+        except ValueError:
+            continue
+        if key not in wanted:
+            continue
+        try:
+            with open("/proc/{}/comm".format(pid)) as f:
+                name = f.read().strip()
+        except OSError:
+            # open file description locks do not record their owner
+            name = "unknown"
+        return pid, name
+    return None
+
+
+def _progress_message(line: str) -> Optional[str]:
+    """Return a short description of the progress reported by a line of apt output, if any."""
+    match = APT_STATUS_MATCHER.match(line)
+    if match:
+        try:
+            percent = float(match.group(1))
+        except ValueError:
+            return None
+        return "{} ({:.0f}%)".format(match.group(2).strip(), percent)
+    match = APT_FETCH_MATCHER.match(line)
+    if match:
+        return "Fetching {}".format(match.group(1))
+    return None
+
+
+def _stream_apt(cmd: List[str], progress: Optional[Callable[[str], None]] = None) -> str:
+    """Run an apt command, consuming its output line by line as it is produced.
+
+    Reading as the command writes means it never blocks on a full pipe. Progress lines are
+    passed to `progress`, at most once every `PROGRESS_INTERVAL` seconds, and only the last
+    `APT_OUTPUT_TAIL` lines are kept.
+
+    Returns:
+        the tail of the output of the command
+
+    Raises:
+        CalledProcessError if the command fails, with the tail of its output
+    """
+    tail = deque(maxlen=APT_OUTPUT_TAIL)
+    last_report = None
+    with subprocess.Popen(
+        cmd,
+        stdout=PIPE,
+        stderr=STDOUT,
+        universal_newlines=True,
+        encoding="utf-8",
+        errors="replace",
+    ) as proc:
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            tail.append(line)
+            if progress is None:
+                continue
+            message = _progress_message(line)
+            now = time.monotonic()
+            if message is None or (
+                last_report is not None and now - last_report < PROGRESS_INTERVAL
+            ):
+                continue
+            last_report = now
+            progress(message)
+
+    output = "\n".join(tail)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd, output=output)
+    return output
+
+
+def _run_apt(
+    cmd: List[str],
+    lock_files: Iterable[str],
+    progress: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Run an apt command, waiting for another process to release the apt and dpkg locks.
+
+    apt is asked to report its progress on stdout, see `_stream_apt`. When the command
+    fails because one of `lock_files` is taken, it is retried with exponential backoff
+    until `LOCK_TIMEOUT` seconds have passed.
+
+    Args:
+        cmd: the `apt-get` command to run
+        lock_files: the lock files the command takes
+        progress: an (Optional) callable, given a message as the command progresses or
+            while waiting for a lock
+
+    Returns:
+        the tail of the output of the command
+
+    Raises:
+        CalledProcessError if the command fails, or the locks are not released in time
+    """
+    cmd = [cmd[0], "-o", "APT::Status-Fd=1", *cmd[1:]]
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    delay = 0.5
+    while True:
+        try:
+            return _stream_apt(cmd, progress=progress)
+        except CalledProcessError as e:
+            if not APT_LOCK_ERROR_MATCHER.search(e.output or ""):
+                raise
+            holder = _lock_holder(lock_files)
+            remaining = deadline - time.monotonic()
+            if holder is None:
+                description = "another process"
+            else:
+                description = "{} (pid {})".format(holder[1], holder[0])
+            if remaining <= 0:
+                logger.error("timed out waiting for the apt lock held by %s", description)
+                raise
+
+        message = "Waiting for the apt lock held by {}".format(description)
+        logger.info("%s, retrying in %.1fs", message, min(delay, remaining))
+        if progress is not None:
+            progress(message)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, LOCK_MAX_BACKOFF)
+
+
 class DebianPackage:
     """Represents a traditional Debian package and its utility functions.
 
@@ -234,6 +847,7 @@ class DebianPackage:
         command: str,
         package_names: Union[str, List],
         optargs: Optional[List[str]] = None,
+        progress: Optional[Callable[[str], None]] = None,
     ) -> None:
         """Wrap package management commands for Debian/Ubuntu systems.
 
@@ -241,6 +855,7 @@ class DebianPackage:
           command: the command given to `apt-get`
           package_names: a package name or list of package names to operate on
           optargs: an (Optional) list of additioanl arguments
+          progress: an (Optional) callable, given progress messages for the unit status
 
         Raises:
           PackageError if an error is encountered
@@ -250,7 +865,7 @@ class DebianPackage:
             package_names = [package_names]
         _cmd = ["apt-get", "-y", *optargs, command, *package_names]
         try:
-            check_call(_cmd, stderr=PIPE, stdout=PIPE)
+            _run_apt(_cmd, DPKG_LOCK_FILES, progress=progress)
         except CalledProcessError as e:
             raise PackageError(
                 "Could not {} package(s) [{}]: {}".format(command, [*package_names], e.output)
@@ -392,60 +1007,20 @@ class DebianPackage:
             arch: an optional architecture, defaulting to `dpkg --print-architecture`.
                 If an architecture is not specified, this will be used for selection.
         """
-        system_arch = check_output(
-            ["dpkg", "--print-architecture"], universal_newlines=True
-        ).strip()
-        arch = arch if arch else system_arch
+        arch = arch if arch else _get_system_arch()
 
-        # Regexps are a really terrible way to do this. Thanks dpkg
-        output = ""
-        try:
-            output = check_output(["dpkg", "-l", package], stderr=PIPE, universal_newlines=True)
-        except CalledProcessError:
-            raise PackageNotFoundError("Package is not installed: {}".format(package)) from None
-
-        # Pop off the output from `dpkg -l' because there's no flag to
-        # omit it`
-        lines = str(output).splitlines()[5:]
-
-        dpkg_matcher = re.compile(
-            r"""
-        ^(?P<package_status>\w+?)\s+
-        (?P<package_name>.*?)(?P<throwaway_arch>:\w+?)?\s+
-        (?P<version>.*?)\s+
-        (?P<arch>\w+?)\s+
-        (?P<description>.*)
-        """,
-            re.VERBOSE,
-        )
+        installed = _dpkg_status.inventory().lookup(package, arch)
+        if not installed:
+            raise PackageNotFoundError("Package is not installed: {}".format(package))
 
-        for line in lines:
-            try:
-                matches = dpkg_matcher.search(line).groupdict()
-                package_status = matches["package_status"]
-
-                if not package_status.endswith("i"):
-                    logger.debug(
-                        "package '%s' in dpkg output but not installed, status: '%s'",
-                        package,
-                        package_status,
-                    )
-                    break
-
-                epoch, split_version = DebianPackage._get_epoch_from_version(matches["version"])
-                pkg = DebianPackage(
-                    matches["package_name"],
-                    split_version,
-                    epoch,
-                    matches["arch"],
-                    PackageState.Present,
-                )
-                if (pkg.arch == "all" or pkg.arch == arch) and (
-                    version == "" or str(pkg.version) == version
-                ):
-                    return pkg
-            except AttributeError:
-                logger.warning("dpkg matcher could not parse line: %s", line)
+        for record in installed:
+            pkg = DebianPackage(
+                package, record.version, record.epoch, record.arch, PackageState.Present
+            )
+            if (pkg.arch == "all" or pkg.arch == arch) and (
+                version == "" or str(pkg.version) == version
+            ):
+                return pkg
 
         # If we didn't find it, fail through
         raise PackageNotFoundError("Package {}.{} is not installed!".format(package, arch))
@@ -462,45 +1037,21 @@ class DebianPackage:
             arch: an optional architecture, defaulting to `dpkg --print-architecture`.
                 If an architecture is not specified, this will be used for selection.
         """
-        system_arch = check_output(
-            ["dpkg", "--print-architecture"], universal_newlines=True
-        ).strip()
-        arch = arch if arch else system_arch
+        arch = arch if arch else _get_system_arch()
 
-        # Regexps are a really terrible way to do this. Thanks dpkg
-        keys = ("Package", "Architecture", "Version")
+        candidates = _apt_lists.lookup(package)
+        if candidates is None:
+            candidates = DebianPackage._apt_cache_show(package)
 
-        try:
-            output = check_output(
-                ["apt-cache", "show", package], stderr=PIPE, universal_newlines=True
-            )
-        except CalledProcessError as e:
-            raise PackageError(
-                "Could not list packages in apt-cache: {}".format(e.output)
-            ) from None
-
-        pkg_groups = output.strip().split("\n\n")
-        keys = ("Package", "Architecture", "Version")
-
-        for pkg_raw in pkg_groups:
-            lines = str(pkg_raw).splitlines()
-            vals = {}
-            for line in lines:
-                if line.startswith(keys):
-                    items = line.split(":", 1)
-                    vals[items[0]] = items[1].strip()
-                else:
-                    continue
-
-            epoch, split_version = DebianPackage._get_epoch_from_version(vals["Version"])
-            pkg = DebianPackage(
-                vals["Package"],
-                split_version,
-                epoch,
-                vals["Architecture"],
-                PackageState.Available,
+        pkgs = []
+        for pkg_arch, pkg_version in candidates:
+            epoch, split_version = DebianPackage._get_epoch_from_version(pkg_version)
+            pkgs.append(
+                DebianPackage(package, split_version, epoch, pkg_arch, PackageState.Available)
             )
 
+        # Several lists may carry the package, prefer the newest like apt would
+        for pkg in sorted(pkgs, key=lambda p: p.version.sort_key, reverse=True):
             if (pkg.arch == "all" or pkg.arch == arch) and (
                 version == "" or str(pkg.version) == version
             ):
@@ -509,6 +1060,22 @@ class DebianPackage:
         # If we didn't find it, fail through
         raise PackageNotFoundError("Package {}.{} is not in the apt cache!".format(package, arch))
 
+    @staticmethod
+    def _apt_cache_show(package: str) -> List[Tuple[str, str]]:
+        """Return the (arch, version) pairs reported by `apt-cache show`."""
+        try:
+            output = check_output(
+                ["apt-cache", "show", package], stderr=PIPE, universal_newlines=True
+            )
+        except CalledProcessError as e:
+            raise PackageError(
+                "Could not list packages in apt-cache: {}".format(e.output)
+            ) from None
+
+        return [
+            (arch, version) for name, _, arch, version in _parse_stanzas(output) if name == package
+        ]
+
 
 class Version:
     """An abstraction around package versions.
@@ -518,15 +1085,25 @@ class Version:
 
     This class implements the algorithm found here:
     https://www.debian.org/doc/debian-policy/ch-controlfields.html#version
+
+    Each version is reduced once to a sort key which orders like `dpkg --compare-versions`, so
+    comparing, sorting or hashing versions never parses them again.
     """
 
+    __slots__ = ("_version", "_epoch", "_key")
+
     def __init__(self, version: str, epoch: str):
         self._version = version
         self._epoch = epoch or ""
+        self._key = None
 
     def __repr__(self):
         """A representation of the package."""
-        return "<{}.{}: {}>".format(self.__module__, self.__class__.__name__, self.__dict__)
+        return "<{}.{}: {}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            {"_version": self._version, "_epoch": self._epoch},
+        )
 
     def __str__(self):
         """A human-readable representation of the package."""
@@ -542,6 +1119,18 @@ class Version:
         """Returns the version number for a package."""
         return self._version
 
+    @property
+    def sort_key(self) -> Tuple:
+        """Returns a key which sorts like the Debian version ordering. Computed once."""
+        if self._key is None:
+            upstream_version, debian_version = self._get_parts(self._version)
+            self._key = (
+                int(self._epoch or 0),
+                self._revision_key(upstream_version),
+                self._revision_key(debian_version),
+            )
+        return self._key
+
     def _get_parts(self, version: str) -> Tuple[str, str]:
         """Separate the version into component upstream and Debian pieces."""
         try:
@@ -594,131 +1183,100 @@ class Version:
         # string is entirely digits
         return int(revision), ""
 
-    def _dstringcmp(self, a, b):  # noqa: C901
-        """Debian package version string section lexical sort algorithm.
+    @staticmethod
+    def _dstring_key(part: str) -> Tuple[int, ...]:
+        """Turn a non-digit part into a tuple which sorts lexically like Debian strings.
 
-        The lexical comparison is a comparison of ASCII values modified so
-        that all the letters sort earlier than all the non-letters and so that
-        a tilde sorts before anything, even the end of a part.
+        All the letters sort earlier than all the non-letters, and a tilde sorts before
+        anything, even the end of a part, which is represented by the trailing 0.
         """
-        if a == b:
-            return 0
-        try:
-            for i, char in enumerate(a):
-                if char == b[i]:
-                    continue
-                # "a tilde sorts before anything, even the end of a part"
-                # (emptyness)
-                if char == "~":
-                    return -1
-                if b[i] == "~":
-                    return 1
-                # "all the letters sort earlier than all the non-letters"
-                if char.isalpha() and not b[i].isalpha():
-                    return -1
-                if not char.isalpha() and b[i].isalpha():
-                    return 1
-                # otherwise lexical sort
-                if ord(char) > ord(b[i]):
-                    return 1
-                if ord(char) < ord(b[i]):
-                    return -1
-        except IndexError:
-            # a is longer than b but otherwise equal, greater unless there are tildes
-            if char == "~":
-                return -1
-            return 1
-        # if we get here, a is shorter than b but otherwise equal, so check for tildes...
-        if b[len(a)] == "~":
-            return 1
-        return -1
-
-    def _compare_revision_strings(self, first: str, second: str):  # noqa: C901
-        """Compare two debian revision strings."""
-        if first == second:
-            return 0
-
-        # listify pads results so that we will always be comparing ints to ints
-        # and strings to strings (at least until we fall off the end of a list)
-        first_list = self._listify(first)
-        second_list = self._listify(second)
-        if first_list == second_list:
-            return 0
-        try:
-            for i, item in enumerate(first_list):
-                # explicitly raise IndexError if we've fallen off the edge of list2
-                if i >= len(second_list):
-                    raise IndexError
-                # if the items are equal, next
-                if item == second_list[i]:
-                    continue
-                # numeric comparison
-                if isinstance(item, int):
-                    if item > second_list[i]:
-                        return 1
-                    if item < second_list[i]:
-                        return -1
-                else:
-                    # string comparison
-                    return self._dstringcmp(item, second_list[i])
-        except IndexError:
-            # rev1 is longer than rev2 but otherwise equal, hence greater
-            # ...except for goddamn tildes
-            if first_list[len(second_list)][0][0] == "~":
-                return 1
-            return 1
-        # rev1 is shorter than rev2 but otherwise equal, hence lesser
-        # ...except for goddamn tildes
-        if second_list[len(first_list)][0][0] == "~":
-            return -1
-        return -1
+        return tuple(-1 if c == "~" else ord(c) if c.isalpha() else ord(c) + 256 for c in part) + (
+            0,
+        )
 
-    def _compare_version(self, other) -> int:
-        if (self.number, self.epoch) == (other.number, other.epoch):
-            return 0
+    def _revision_key(self, revision: str) -> Tuple:
+        """Turn an upstream or Debian revision into a tuple of alternating parts.
+
+        An empty revision compares like "0", and the trailing empty part stands in for
+        whatever the other revision has left, so that "1.0~rc1" sorts before "1.0".
+        """
+        parts = self._listify(revision) or ["", 0]
+        key = [p if isinstance(p, int) else self._dstring_key(p) for p in parts]
+        key.append(self._dstring_key(""))
+        return tuple(key)
 
-        if self.epoch < other.epoch:
+    def _compare_version(self, other) -> int:
+        if self.sort_key < other.sort_key:
             return -1
-        if self.epoch > other.epoch:
+        if self.sort_key > other.sort_key:
             return 1
-
-        # If none of these are true, follow the algorithm
-        upstream_version, debian_version = self._get_parts(self.number)
-        other_upstream_version, other_debian_version = self._get_parts(other.number)
-
-        upstream_cmp = self._compare_revision_strings(upstream_version, other_upstream_version)
-        if upstream_cmp != 0:
-            return upstream_cmp
-
-        debian_cmp = self._compare_revision_strings(debian_version, other_debian_version)
-        if debian_cmp != 0:
-            return debian_cmp
-
         return 0
 
+    def __hash__(self):
+        """Hash consistently with equality, so equivalent versions collapse in sets."""
+        return hash(self.sort_key)
+
     def __lt__(self, other) -> bool:
         """Less than magic method impl."""
-        return self._compare_version(other) < 0
+        return self.sort_key < other.sort_key
 
     def __eq__(self, other) -> bool:
         """Equality magic method impl."""
-        return self._compare_version(other) == 0
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key == other.sort_key
 
     def __gt__(self, other) -> bool:
         """Greater than magic method impl."""
-        return self._compare_version(other) > 0
+        return self.sort_key > other.sort_key
 
     def __le__(self, other) -> bool:
         """Less than or equal to magic method impl."""
-        return self.__eq__(other) or self.__lt__(other)
+        return self.sort_key <= other.sort_key
 
     def __ge__(self, other) -> bool:
         """Greater than or equal to magic method impl."""
-        return self.__gt__(other) or self.__eq__(other)
+        return self.sort_key >= other.sort_key
 
     def __ne__(self, other) -> bool:
         """Not equal to magic method impl."""
-        return not self.__eq__(other)
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key != other.sort_key
+
+
+def _as_version(version: Union[str, Version]) -> Version:
+    """Return a `Version` from either a version string, with optional epoch, or a `Version`."""
+    if isinstance(version, Version):
+        return version
+    epoch, number = DebianPackage._get_epoch_from_version(version)
+    return Version(number, epoch)
+
+
+def sort_versions(
+    versions: Iterable[Union[str, Version]], reverse: Optional[bool] = False
+) -> List[Version]:
+    """Sort versions following the Debian version ordering.
+
+    Args:
+        versions: version strings such as "1:2.3-1ubuntu1", or `Version` objects
+        reverse: sort from newest to oldest
+
+    Returns: a list of `Version` objects
+    """
+    return sorted((_as_version(v) for v in versions), key=Version.sort_key.fget, reverse=reverse)
+
+
+def max_version(versions: Iterable[Union[str, Version]]) -> Version:
+    """Return the newest version following the Debian version ordering.
+
+    Args:
+        versions: version strings such as "1:2.3-1ubuntu1", or `Version` objects
+
+    Raises:
+        ValueError if no versions are given
+    """
+    return max((_as_version(v) for v in versions), key=Version.sort_key.fget)
 
 
 def add_package(
@@ -726,6 +1284,8 @@ def add_package(
     version: Optional[str] = "",
     arch: Optional[str] = "",
     update_cache: Optional[bool] = False,
+    sources: Optional[Iterable[Union["DebianRepository", str]]] = None,
+    progress: Optional[Callable[[str], None]] = None,
 ) -> Union[DebianPackage, List[DebianPackage]]:
     """Add a package or list of packages to the system.
 
@@ -734,13 +1294,17 @@ def add_package(
         version: an (Optional) version as a string. Defaults to the latest known
         arch: an optional architecture for the package
         update_cache: whether or not to run `apt-get update` prior to operating
+        sources: an (Optional) list of the repositories providing the packages. When given,
+            only their indexes are refreshed before operating or retrying.
+        progress: an (Optional) callable, given progress messages for the unit status
 
     Raises:
         PackageNotFoundError if the package is not in the cache.
     """
+    sources = list(sources) if sources is not None else None
     cache_refreshed = False
     if update_cache:
-        update()
+        update(sources=sources, progress=progress)
         cache_refreshed = True
 
     packages = {"success": [], "retry": [], "failed": []}
@@ -754,24 +1318,20 @@ def add_package(
             "Explicit version should not be set if more than one package is being added!"
         )
 
-    for p in package_names:
-        pkg, success = _add(p, version, arch)
-        if success:
-            packages["success"].append(pkg)
-        else:
-            logger.warning("failed to locate and install/update '%s'", pkg)
-            packages["retry"].append(p)
+    # resolve everything first, then install the lot in a single dpkg transaction
+    packages["success"], packages["retry"] = _resolve(package_names, version, arch)
+    for p in packages["retry"]:
+        logger.warning("failed to locate and install/update '%s'", p)
 
     if packages["retry"] and not cache_refreshed:
         logger.info("updating the apt-cache and retrying installation of failed packages.")
-        update()
+        update(sources=sources, progress=progress)
+        found, packages["failed"] = _resolve(packages["retry"], version, arch)
+        packages["success"].extend(found)
+    else:
+        packages["failed"] = packages["retry"]
 
-        for p in packages["retry"]:
-            pkg, success = _add(p, version, arch)
-            if success:
-                packages["success"].append(pkg)
-            else:
-                packages["failed"].append(p)
+    _add(packages["success"], progress=progress)
 
     if packages["failed"]:
         raise PackageError("Failed to install packages: {}".format(", ".join(packages["failed"])))
@@ -779,36 +1339,92 @@ def add_package(
     return packages["success"] if len(packages["success"]) > 1 else packages["success"][0]
 
 
-def _add(
-    name: str,
+def _resolve(
+    names: List[str],
     version: Optional[str] = "",
     arch: Optional[str] = "",
-) -> Tuple[Union[DebianPackage, str], bool]:
-    """Adds a package.
+) -> Tuple[List[DebianPackage], List[str]]:
+    """Look up packages either on the system or in the apt cache.
 
     Args:
-        name: the name(s) of the package(s)
+        names: the names of the packages
         version: an (Optional) version as a string. Defaults to the latest known
         arch: an optional architecture for the package
 
-    Returns: a tuple of `DebianPackage` if found, or a :str: if it is not, and
-        a boolean indicating success
+    Returns: a tuple of the `DebianPackage` objects found, and the names which were not
     """
-    try:
-        pkg = DebianPackage.from_system(name, version, arch)
-        pkg.ensure(state=PackageState.Present)
-        return pkg, True
-    except PackageNotFoundError:
-        return name, False
+    found, missing = [], []
+    for name in dict.fromkeys(names):
+        try:
+            found.append(DebianPackage.from_system(name, version, arch))
+        except PackageNotFoundError:
+            missing.append(name)
+    return found, missing
+
+
+def _add(packages: List[DebianPackage], progress: Optional[Callable[[str], None]] = None) -> None:
+    """Install the packages which are not present yet with a single `apt-get install`.
+
+    Args:
+        packages: a list of `DebianPackage` objects
+        progress: an (Optional) callable, given progress messages for the unit status
+
+    Raises:
+        PackageError from the underlying call to apt
+    """
+    pending = [p for p in packages if not p.present]
+    if not pending:
+        return
+
+    DebianPackage._apt(
+        "install",
+        ["{}={}".format(p.name, p.version) for p in pending],
+        optargs=["--option=Dpkg::Options::=--force-confold"],
+        progress=progress,
+    )
+    for p in pending:
+        p._state = PackageState.Present
+        logger.info("installed '%s'", p)
+
+
+def add_deb_files(
+    paths: Union[str, List[str]], progress: Optional[Callable[[str], None]] = None
+) -> None:
+    """Install local `.deb` files with a single `apt-get install`.
+
+    Unlike `dpkg -i`, apt waits for the dpkg lock and installs the dependencies of the files
+    from the configured repositories.
+
+    Args:
+        paths: the path(s) of the `.deb` file(s)
+        progress: an (Optional) callable, given progress messages for the unit status
+
+    Raises:
+        PackageError if the files could not be installed.
+    """
+    paths = [paths] if type(paths) is str else paths
+    if not paths:
+        raise TypeError("Expected at least one .deb file to add, received zero!")
+
+    # apt only takes an argument as a file, rather than a package name, if it has a slash
+    DebianPackage._apt(
+        "install",
+        [os.path.abspath(p) for p in paths],
+        optargs=["--option=Dpkg::Options::=--force-confold"],
+        progress=progress,
+    )
+    logger.info("installed %s", ", ".join(os.path.basename(p) for p in paths))
 
 
 def remove_package(
-    package_names: Union[str, List[str]]
+    package_names: Union[str, List[str]],
+    progress: Optional[Callable[[str], None]] = None,
 ) -> Union[DebianPackage, List[DebianPackage]]:
     """Removes a package from the system.
 
     Args:
         package_names: the name of a package
+        progress: an (Optional) callable, given progress messages for the unit status
 
     Raises:
         PackageNotFoundError if the package is not found.
@@ -819,22 +1435,144 @@ def remove_package(
     if not package_names:
         raise TypeError("Expected at least one package name to add, received zero!")
 
-    for p in package_names:
+    for p in dict.fromkeys(package_names):
         try:
-            pkg = DebianPackage.from_installed_package(p)
-            pkg.ensure(state=PackageState.Absent)
-            packages.append(pkg)
+            packages.append(DebianPackage.from_installed_package(p))
         except PackageNotFoundError:
             logger.info("package '%s' was requested for removal, but it was not installed.", p)
 
+    # remove everything in a single dpkg transaction
+    if packages:
+        DebianPackage._apt(
+            "remove", ["{}={}".format(p.name, p.version) for p in packages], progress=progress
+        )
+        for pkg in packages:
+            pkg._state = PackageState.Absent
+
     # the list of packages will be empty when no package is removed
     logger.debug("packages: '%s'", packages)
     return packages[0] if len(packages) == 1 else packages
 
 
-def update() -> None:
-    """Updates the apt cache via `apt-get update`."""
-    check_call(["apt-get", "update"], stderr=PIPE, stdout=PIPE)
+@contextlib.contextmanager
+def _restored_stamp(stamp: Optional[os.stat_result]):
+    """Put the success stamp back to `stamp`, removing it if it did not exist."""
+    try:
+        yield
+    finally:
+        try:
+            if stamp is None:
+                os.remove(APT_UPDATE_STAMP)
+            else:
+                os.utime(APT_UPDATE_STAMP, ns=(stamp.st_atime_ns, stamp.st_mtime_ns))
+        except OSError:
+            pass
+
+
+def _update_sources(
+    sources: Iterable[Union["DebianRepository", str]],
+    progress: Optional[Callable[[str], None]] = None,
+) -> None:
+    """Run `apt-get update` against a throwaway sources directory holding only `sources`.
+
+    The success stamp, which apt's own hook touches after any successful update, is put
+    back as it was: the other sources were not refreshed.
+    """
+    try:
+        stamp = os.stat(APT_UPDATE_STAMP)
+    except FileNotFoundError:
+        stamp = None
+    with tempfile.TemporaryDirectory(prefix="apt-sources-") as parts_dir, _restored_stamp(stamp):
+        for n, source in enumerate(sources):
+            if isinstance(source, DebianRepository):
+                with open(os.path.join(parts_dir, "{}.list".format(n)), "w") as f:
+                    f.write(source._to_line())
+            else:
+                ext = ".sources" if source.endswith(".sources") else ".list"
+                shutil.copyfile(source, os.path.join(parts_dir, "{}{}".format(n, ext)))
+
+        logger.debug("updating the apt indexes of: %s", sorted(os.listdir(parts_dir)))
+        _run_apt(
+            [
+                "apt-get",
+                "update",
+                "-o",
+                "Dir::Etc::SourceList=/dev/null",
+                "-o",
+                "Dir::Etc::SourceParts={}".format(parts_dir),
+                # keep the indexes of every other source
+                "-o",
+                "APT::Get::List-Cleanup=0",
+            ],
+            APT_LISTS_LOCK_FILES,
+            progress=progress,
+        )
+
+
+def _index_age() -> Optional[float]:
+    """Return how many seconds ago the apt index was last fully refreshed, if that is known.
+
+    Only the success stamp is considered, which is touched after a full and successful
+    update. The lists directory also changes on partial, failed or targeted updates.
+    """
+    try:
+        mtime = os.stat(APT_UPDATE_STAMP).st_mtime
+    except FileNotFoundError:
+        return None
+    return max(0.0, time.time() - mtime)
+
+
+def _touch_update_stamp() -> None:
+    """Record a successful refresh for `_index_age`, the same way apt's own hook does."""
+    try:
+        os.makedirs(os.path.dirname(APT_UPDATE_STAMP), exist_ok=True)
+        with open(APT_UPDATE_STAMP, "a"):
+            os.utime(APT_UPDATE_STAMP)
+    except OSError as e:
+        logger.debug("could not touch %s: %s", APT_UPDATE_STAMP, e)
+
+
+def update(
+    max_age: Optional[float] = None,
+    sources: Optional[Iterable[Union["DebianRepository", str]]] = None,
+    progress: Optional[Callable[[str], None]] = None,
+) -> None:
+    """Updates the apt cache via `apt-get update`.
+
+    Concurrent calls within a process are collapsed: a caller waiting on a refresh which
+    started after it asked for one does not run another.
+
+    Args:
+        max_age: an (Optional) number of seconds. If the index was refreshed more recently
+            than this, by this charm or anything else on the machine, nothing is done.
+            Ignored for targeted refreshes.
+        sources: an (Optional) list of `DebianRepository` objects or paths to `.list` and
+            `.sources` files. Only the indexes of these sources are refreshed, the others
+            are left as they are.
+        progress: an (Optional) callable, given progress messages for the unit status
+    """
+    global _last_update_started
+
+    if sources is not None:
+        with _update_lock:
+            _update_sources(sources, progress=progress)
+        return
+
+    requested = time.monotonic()
+    if max_age is not None:
+        age = _index_age()
+        if age is not None and age <= max_age:
+            logger.debug("apt index refreshed %ds ago, not updating", age)
+            return
+
+    with _update_lock:
+        if _last_update_started is not None and _last_update_started >= requested:
+            logger.debug("apt index refreshed by a concurrent update, not updating")
+            return
+        started = time.monotonic()
+        _run_apt(["apt-get", "update"], APT_LISTS_LOCK_FILES, progress=progress)
+        _last_update_started = started
+        _touch_update_stamp()
 
 
 class InvalidSourceError(Error):
@@ -926,7 +1664,7 @@ class DebianRepository:
         Combining `gpg_key`, if set, and the rest of the options to find
         a complex repo string.
         """
-        options = self._options if self._options else {}
+        options = dict(self._options or {})
         if self._gpg_key_filename:
             options["signed-by"] = self._gpg_key_filename
 
@@ -936,6 +1674,40 @@ class DebianRepository:
             else ""
         )
 
+    def _to_line(self) -> str:
+        """Render the repository as a one-line `sources.list` entry."""
+        return (
+            "{}".format("#" if not self.enabled else "")
+            + "{} {}{} ".format(self.repotype, self.make_options_string(), self.uri)
+            + "{} {}\n".format(self.release, " ".join(self.groups))
+        )
+
+    def _to_stanza(self) -> List[str]:
+        """Render the repository as the lines of a deb822 `.sources` stanza."""
+        lines = [
+            "Types: {}".format(self.repotype),
+            "URIs: {}".format(self.uri),
+            "Suites: {}".format(self.release),
+        ]
+        if self.groups:
+            lines.append("Components: {}".format(" ".join(self.groups)))
+        if not self.enabled:
+            lines.append("Enabled: no")
+        if self.gpg_key:
+            lines.append("Signed-By: {}".format(self.gpg_key))
+        fields = {v: k for k, v in DEB822_OPTIONS.items()}
+        for key, value in (self.options or {}).items():
+            if key == "signed-by":
+                continue
+            name = "-".join(w.capitalize() for w in fields.get(key, key).split("-"))
+            lines.append("{}: {}".format(name, " ".join(value.split(","))))
+        return lines
+
+    @property
+    def _identifier(self) -> str:
+        """The key of the repository in a `RepositoryMapping`."""
+        return "{}-{}-{}".format(self.repotype, self.uri, self.release)
+
     @staticmethod
     def prefix_from_uri(uri: str) -> str:
         """Get a repo list prefix from the uri, depending on whether a path is set."""
@@ -959,7 +1731,7 @@ class DebianRepository:
         )
         repo.filename = fname
 
-        options = repo.options if repo.options else {}
+        options = dict(repo.options or {})
         if repo.gpg_key:
             options["signed-by"] = repo.gpg_key
 
@@ -986,16 +1758,10 @@ class DebianRepository:
     def disable(self) -> None:
         """Remove this repository from consideration.
 
-        Disable it instead of removing from the repository file.
+        Disable it instead of removing from the repository file, which may be a one-line
+        `.list` file or a deb822 `.sources` file.
         """
-        searcher = "{} {}{} {}".format(
-            self.repotype, self.make_options_string(), self.uri, self.release
-        )
-        for line in fileinput.input(self._filename, inplace=True):
-            if re.match(r"^{}\s".format(re.escape(searcher)), line):
-                print("# {}".format(line), end="")
-            else:
-                print(line, end="")
+        RepositoryMapping().disable(self)
 
     def import_key(self, key: str) -> None:
         """Import an ASCII Armor key.
@@ -1013,6 +1779,9 @@ class DebianRepository:
           key: A GPG key in ASCII armor format,
                       including BEGIN and END markers or a keyid.
 
+        A key which was imported before is recognised without running gpg, see
+        `import_keys`, which also imports several keys at once.
+
         Raises:
           GPGKeyError if the key could not be imported
         """
@@ -1022,17 +1791,10 @@ class DebianRepository:
             # we trust its validation better than our own. eg. handling
             # comments before the key.
             logger.debug("PGP key found (looks like ASCII Armor format)")
-            if (
+            if not (
                 "-----BEGIN PGP PUBLIC KEY BLOCK-----" in key
                 and "-----END PGP PUBLIC KEY BLOCK-----" in key
             ):
-                logger.debug("Writing provided PGP key in the binary format")
-                key_bytes = key.encode("utf-8")
-                key_name = self._get_keyid_by_gpg_key(key_bytes)
-                key_gpg = self._dearmor_gpg_key(key_bytes)
-                self._gpg_key_filename = "/etc/apt/trusted.gpg.d/{}.gpg".format(key_name)
-                self._write_apt_gpg_keyfile(key_name=self._gpg_key_filename, key_material=key_gpg)
-            else:
                 raise GPGKeyError("ASCII armor markers missing from GPG key")
         else:
             logger.warning(
@@ -1045,11 +1807,7 @@ class DebianRepository:
             # apt-key in general as noted in its manpage. See lp:1433761 for more
             # history. Instead, /etc/apt/trusted.gpg.d is used directly to drop
             # gpg
-            key_asc = self._get_key_by_keyid(key)
-            # write the key in GPG format so that apt-key list shows it
-            key_gpg = self._dearmor_gpg_key(key_asc.encode("utf-8"))
-            self._gpg_key_filename = "/etc/apt/trusted.gpg.d/{}.gpg".format(key)
-            self._write_apt_gpg_keyfile(key_name=key, key_material=key_gpg)
+        self._gpg_key_filename = import_keys([key])[0]
 
     @staticmethod
     def _get_keyid_by_gpg_key(key_material: bytes) -> str:
@@ -1149,12 +1907,486 @@ class DebianRepository:
             keyf.write(key_material)
 
 
+def _crc24(data: bytes) -> int:
+    """Return the CRC-24 checksum of ASCII armored data (RFC 4880, section 6.1)."""
+    crc = 0xB704CE
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def _dearmor(key_asc: bytes) -> bytes:
+    """Convert a GPG key in the ASCII armor format to the binary format, without gpg.
+
+    Raises:
+      GPGKeyError if the armor is malformed or its checksum does not match
+    """
+    lines = key_asc.decode("ascii", "replace").splitlines()
+    try:
+        start = next(i for i, line in enumerate(lines) if line.startswith("-----BEGIN PGP"))
+        end = next(i for i in range(start + 1, len(lines)) if lines[i].startswith("-----END"))
+    except StopIteration:
+        raise GPGKeyError("ASCII armor markers missing from GPG key") from None
+
+    body = [line.strip() for line in lines[start + 1 : end]]
+    # armor headers, such as "Comment: ...", end with an empty line
+    if "" in body:
+        body = body[body.index("") + 1 :]
+    checksum = None
+    if body and body[-1].startswith("="):
+        checksum = body.pop()[1:]
+    try:
+        data = base64.b64decode("".join(body), validate=True)
+        if checksum is not None and _crc24(data) != int.from_bytes(
+            base64.b64decode(checksum, validate=True), "big"
+        ):
+            raise GPGKeyError("Invalid GPG key material: checksum mismatch")
+    except ValueError:
+        raise GPGKeyError("Invalid GPG key material: malformed ASCII armor") from None
+    if not data:
+        raise GPGKeyError("Invalid GPG key material provided")
+    return data
+
+
+def _gpg_fingerprints(key_material: bytes) -> List[str]:
+    """Return the fingerprints of the primary keys in GPG key material, with one gpg call."""
+    ps = subprocess.run(
+        ["gpg", "--with-colons", "--with-fingerprint"],
+        stdout=PIPE,
+        stderr=PIPE,
+        input=key_material,
+    )
+    if "gpg: no valid OpenPGP data found." in ps.stderr.decode():
+        raise GPGKeyError("Invalid GPG key material provided")
+    fingerprints = []
+    primary = False
+    for line in ps.stdout.decode().splitlines():
+        fields = line.split(":")
+        if fields[0] == "pub":
+            primary = True
+        elif fields[0] == "fpr" and primary and len(fields) > 9:
+            # from gnupg2 docs: fpr :: Fingerprint (fingerprint is in field 10)
+            fingerprints.append(fields[9])
+            primary = False
+    return fingerprints
+
+
+class _GPGKeyIndex:
+    """The keys imported by `import_keys`, by hash of the key as it was given."""
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path or GPG_KEY_INDEX
+        self._changed = False
+        try:
+            with open(self._path) as f:
+                self._entries: Dict[str, Dict[str, str]] = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def lookup(self, digest: str) -> Optional[str]:
+        """Return the keyring file of a key, if it is installed and unchanged."""
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        try:
+            with open(entry["path"], "rb") as f:
+                installed = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+        return entry["path"] if installed == entry["sha256"] else None
+
+    def record(self, digest: str, fingerprint: str, path: str, key_material: bytes) -> None:
+        """Record the keyring file a key was written to."""
+        self._entries[digest] = {
+            "fingerprint": fingerprint,
+            "path": path,
+            "sha256": hashlib.sha256(key_material).hexdigest(),
+        }
+        self._changed = True
+
+    def save(self) -> None:
+        """Write the index, if it changed."""
+        if not self._changed:
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        _write_atomic(self._path, json.dumps(self._entries, indent=2, sort_keys=True) + "\n")
+        self._changed = False
+
+
+def import_keys(keys: Iterable[str]) -> List[str]:
+    """Import several GPG keys into `/etc/apt/trusted.gpg.d` at once.
+
+    Keys which were imported before, and whose keyring file is unchanged, are recognised
+    from an index kept in `GPG_KEY_INDEX`, without running gpg or writing anything. The
+    fingerprints of the other keys are read with a single gpg call.
+
+    Args:
+      keys: GPG keys in ASCII armor format, including BEGIN and END markers, or keyids
+        to fetch from the Ubuntu keyserver
+
+    Returns:
+      the paths of the keyring files, in the order of the keys
+
+    Raises:
+      GPGKeyError if a key could not be imported
+    """
+    index = _GPGKeyIndex()
+    paths: List[Optional[str]] = []
+    pending = []
+    for key in keys:
+        key = key.strip()
+        if "-" in key or "\n" in key:
+            digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+            keyid = None
+        else:
+            digest = "keyid:{}".format(key.upper())
+            keyid = key
+        path = index.lookup(digest)
+        paths.append(path)
+        if path is not None:
+            logger.debug("GPG key already installed in '%s'", path)
+            continue
+
+        if keyid is None:
+            key_material = _dearmor(key.encode("utf-8"))
+        else:
+            key_material = _dearmor(DebianRepository._get_key_by_keyid(keyid).encode("utf-8"))
+        pending.append((len(paths) - 1, digest, keyid, key_material))
+
+    if pending:
+        fingerprints = _gpg_fingerprints(b"".join(p[-1] for p in pending))
+        if len(fingerprints) != len(pending):
+            # some of the keys hold several primary keys, ask for each key on its own
+            fingerprints = [_gpg_fingerprints(p[-1])[0] for p in pending]
+        for (i, digest, keyid, key_material), fingerprint in zip(pending, fingerprints):
+            path = os.path.join(TRUSTED_GPG_DIR, "{}.gpg".format(keyid or fingerprint))
+            logger.debug("Writing provided PGP key in the binary format to '%s'", path)
+            _write_atomic(path, key_material)
+            index.record(digest, fingerprint, path, key_material)
+            paths[i] = path
+        index.save()
+    return paths
+
+
+def _write_atomic(path: str, content: Union[str, bytes]) -> None:
+    """Replace the content of a file in one step, so apt never reads it half written."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+    # apt silently ignores files ending in .save while the new content is written
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".save"
+    )
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _set_deb822_field(stanza: List[str], name: str, value: str) -> List[str]:
+    """Return the lines of a deb822 stanza with a single-line field set to `value`."""
+    lines = []
+    replaced = skipping = False
+    for line in stanza:
+        if skipping and line[:1] in (" ", "\t"):
+            continue
+        skipping = False
+        key = line.partition(":")[0]
+        if line[:1] not in ("#", " ", "\t") and key.strip().lower() == name.lower():
+            skipping = True
+            if not replaced:
+                lines.append("{}: {}".format(name, value))
+                replaced = True
+            continue
+        lines.append(line)
+    if not replaced:
+        lines.append("{}: {}".format(name, value))
+    return lines
+
+
+class RepositoryTransaction:
+    """Changes to the repository files, queued and then applied together.
+
+    Each changed file is written once, atomically. Lines and deb822 stanzas which are not
+    affected by the changes are kept as they are. When several operations are queued for
+    the same repository, the last one wins.
+
+    Created by `RepositoryMapping.transaction`.
+    """
+
+    def __init__(self, mapping: "RepositoryMapping"):
+        self._mapping = mapping
+        # the queued operation for each repository identifier, by file
+        self._changes: Dict[str, Dict[str, Tuple[str, DebianRepository]]] = {}
+
+    def _queue(self, operation: str, repo: DebianRepository, filename: str) -> None:
+        if not filename:
+            raise InvalidSourceError("no file is known for {}".format(repo._identifier))
+        self._changes.setdefault(filename, {})[repo._identifier] = (operation, repo)
+
+    def add(self, repo: DebianRepository) -> None:
+        """Queue adding a repository, or replacing its entry in `repo.filename`.
+
+        Args:
+          repo: a `DebianRepository` object. The entry is written to a `.sources` file as
+            a deb822 stanza, to any other file as a one-line entry.
+        """
+        filename = repo.filename or "{}-{}.list".format(
+            DebianRepository.prefix_from_uri(repo.uri), repo.release.replace("/", "-")
+        )
+        self._queue("add", repo, filename)
+
+    def disable(self, repo: DebianRepository) -> None:
+        """Queue disabling a repository, keeping its entry in the file.
+
+        Args:
+          repo: a `DebianRepository` object
+        """
+        self._queue("disable", repo, repo.filename)
+
+    def remove(self, repo: DebianRepository) -> None:
+        """Queue removing the entry of a repository from its file.
+
+        Args:
+          repo: a `DebianRepository` object
+        """
+        self._queue("remove", repo, repo.filename)
+
+    def commit(self, update_cache: Optional[bool] = True) -> List[str]:
+        """Write the changed files, then refresh the indexes of the added repositories.
+
+        Args:
+          update_cache: whether to run a targeted `apt-get update` for the repositories
+            which were added, once all the files are written
+
+        Returns:
+          the paths of the files which were written
+        """
+        changes, self._changes = self._changes, {}
+        written = []
+        for filename, operations in changes.items():
+            content = RepositoryMapping._read_content(filename)
+            if filename.endswith(".sources"):
+                new_content = self._apply_deb822(content, operations)
+            else:
+                new_content = self._apply_lines(content, operations, filename)
+            if new_content != content:
+                _write_atomic(filename, new_content)
+                written.append(filename)
+                logger.info("updated repository file '%s'", filename)
+
+        # the mapping is read again from the files on next access
+        self._mapping._repository_map = None
+        added = []
+        for operations in changes.values():
+            for identifier, (operation, repo) in operations.items():
+                if operation == "add":
+                    self._mapping[identifier] = repo
+                    if repo.enabled:
+                        added.append(repo)
+                elif operation == "remove":
+                    self._mapping._repositories.pop(identifier, None)
+
+        if update_cache and added:
+            update(sources=added)
+        return written
+
+    @staticmethod
+    def _apply_lines(
+        content: str, operations: Dict[str, Tuple[str, DebianRepository]], filename: str
+    ) -> str:
+        """Apply the operations to the content of a one-line style `.list` file."""
+        lines = []
+        done = set()
+        for line in content.splitlines():
+            try:
+                existing = RepositoryMapping._parse(line, filename)
+            except InvalidSourceError:
+                lines.append(line)
+                continue
+            identifier = existing._identifier
+            operation, repo = operations.get(identifier, (None, None))
+            if operation == "add":
+                # replace the first entry of the repository, drop the others
+                if identifier not in done:
+                    lines.append(repo._to_line().rstrip("\n"))
+            elif operation == "disable":
+                lines.append("# {}".format(line) if existing.enabled else line)
+            elif operation != "remove":
+                lines.append(line)
+            done.add(identifier)
+
+        for identifier, (operation, repo) in operations.items():
+            if operation == "add" and identifier not in done:
+                lines.append(repo._to_line().rstrip("\n"))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    @staticmethod
+    def _apply_deb822(content: str, operations: Dict[str, Tuple[str, DebianRepository]]) -> str:
+        """Apply the operations to the content of a deb822 style `.sources` file.
+
+        A stanza defining several repositories, of which only some are changed, is split
+        into one stanza per repository first.
+        """
+        stanzas: List[List[str]] = [[]]
+        for line in content.splitlines():
+            if line.strip():
+                stanzas[-1].append(line)
+            elif stanzas[-1]:
+                stanzas.append([])
+
+        result = []
+        done = set()
+        for stanza in filter(None, stanzas):
+            fields = next(RepositoryMapping._deb822_stanzas("\n".join(stanza)), {})
+            combinations = list(
+                itertools.product(
+                    fields.get("types", "").split(),
+                    fields.get("uris", "").split(),
+                    fields.get("suites", "").split(),
+                )
+            )
+            identifiers = ["{}-{}-{}".format(*c) for c in combinations]
+            disabled = fields.get("enabled", "yes").lower() in ("no", "false", "0")
+            changes = {
+                i: operations[i]
+                for i in identifiers
+                if i in operations and not (disabled and operations[i][0] == "disable")
+            }
+            done.update(i for i in identifiers if i in operations)
+            touched = {operation for operation, _ in changes.values()}
+            if not touched:
+                result.append(stanza)
+                continue
+
+            if len(identifiers) == 1 or (
+                len(touched) == 1 and "add" not in touched and len(changes) == len(identifiers)
+            ):
+                parts = [(identifiers[0], stanza)]
+            else:
+                parts = []
+                for identifier, (repotype, uri, suite) in zip(identifiers, combinations):
+                    # comments stay with the first of the stanzas
+                    part = [line for line in stanza if not (parts and line.startswith("#"))]
+                    part = _set_deb822_field(part, "Types", repotype)
+                    part = _set_deb822_field(part, "URIs", uri)
+                    parts.append((identifier, _set_deb822_field(part, "Suites", suite)))
+
+            for identifier, part in parts:
+                operation, repo = changes.get(identifier, (None, None))
+                if operation == "add":
+                    result.append(repo._to_stanza())
+                elif operation == "disable":
+                    result.append(_set_deb822_field(part, "Enabled", "no"))
+                elif operation != "remove":
+                    result.append(part)
+
+        for identifier, (operation, repo) in operations.items():
+            if operation == "add" and identifier not in done:
+                result.append(repo._to_stanza())
+        return "\n\n".join("\n".join(stanza) for stanza in result) + "\n" if result else ""
+
+
+class _SourcesCache:
+    """Parsed repository files, by path, kept in memory and on disk between hooks.
+
+    Each file is recorded with the (mtime_ns, size, inode) it was parsed at, and with the
+    fields of the repositories it defines, by identifier. The file on disk is read at most
+    once per process.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path or SOURCES_CACHE
+        self._entries: Optional[Dict[str, Tuple[Tuple[int, int, int], List, Dict]]] = None
+        self._changed = False
+
+    def _load(self) -> Dict[str, Tuple[Tuple[int, int, int], List, Dict]]:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self._path) as f:
+                    saved = json.load(f)
+                for filename, entry in saved.items():
+                    self._entries[filename] = (tuple(entry["stamp"]), entry["repos"], {})
+            except (OSError, ValueError, AttributeError, KeyError, TypeError):
+                self._entries = {}
+        return self._entries
+
+    def lookup(
+        self, filename: str, stamp: Tuple[int, int, int]
+    ) -> Optional[Dict[str, "DebianRepository"]]:
+        """Return the repositories of a file, if it was parsed at this stamp."""
+        entry = self._load().get(filename)
+        if entry is None or entry[0] != stamp:
+            return None
+        fields, repos = entry[1], entry[2]
+        if fields and not repos:
+            try:
+                repos.update((i, DebianRepository(*f)) for i, f in fields)
+            except (TypeError, ValueError):
+                return None
+        return repos
+
+    def record(
+        self, filename: str, stamp: Tuple[int, int, int], repos: Dict[str, "DebianRepository"]
+    ) -> None:
+        """Record the repositories parsed from a file."""
+        fields = [
+            [
+                identifier,
+                [r.enabled, r.repotype, r.uri, r.release, r.groups]
+                + [r.filename, r.gpg_key, r.options],
+            ]
+            for identifier, r in repos.items()
+        ]
+        self._load()[filename] = (stamp, fields, repos)
+        self._changed = True
+
+    def clear(self) -> None:
+        """Forget every parsed file, including those read from disk."""
+        self._entries = {}
+        self._changed = True
+
+    def save(self) -> None:
+        """Write the parsed files which still exist to disk, if any was parsed."""
+        if not self._changed:
+            return
+        saved = {
+            filename: {"stamp": list(stamp), "repos": fields}
+            for filename, (stamp, fields, _) in self._load().items()
+            if os.path.exists(filename)
+        }
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            _write_atomic(self._path, json.dumps(saved, sort_keys=True) + "\n")
+        except OSError as e:
+            logger.debug("could not save the parsed repository files: %s", e)
+        self._changed = False
+
+
+_sources_cache = _SourcesCache()
+
+# deb822 fields which have a different name as one-line options
+DEB822_OPTIONS = {"architectures": "arch", "languages": "lang", "targets": "target"}
+
+
 class RepositoryMapping(Mapping):
     """An representation of known repositories.
 
-    Instantiation of `RepositoryMapping` will iterate through the
-    filesystem, parse out repository files in `/etc/apt/...`, and create
-    `DebianRepository` objects in this list.
+    The repository files in `/etc/apt/...` are parsed the first time the mapping is
+    accessed, creating `DebianRepository` objects in this list. Parsed files are cached
+    on disk, so that later hooks too parse them again only when they change.
 
     Typical usage:
 
@@ -1166,66 +2398,193 @@ class RepositoryMapping(Mapping):
     """
 
     def __init__(self):
-        self._repository_map = {}
+        self._repository_map: Optional[Dict[str, DebianRepository]] = None
         # Repositories that we're adding -- used to implement mode param
-        self.default_file = "/etc/apt/sources.list"
-
-        # read sources.list if it exists
-        if os.path.isfile(self.default_file):
-            self.load(self.default_file)
+        self.default_file = APT_SOURCES_LIST
 
-        # read sources.list.d
-        for file in glob.iglob("/etc/apt/sources.list.d/*.list"):
-            self.load(file)
+    @property
+    def _repositories(self) -> Dict[str, DebianRepository]:
+        """The repositories known to apt, read on first access."""
+        if self._repository_map is None:
+            self._repository_map = {}
+            parts = glob.glob(os.path.join(APT_SOURCES_PARTS, "*.list"))
+            parts.extend(glob.glob(os.path.join(APT_SOURCES_PARTS, "*.sources")))
+            for filename in [self.default_file, *sorted(parts)]:
+                try:
+                    repos = self._read(filename)
+                except FileNotFoundError:
+                    continue
+                except (OSError, UnicodeDecodeError) as e:
+                    logger.warning("skipping repository file '%s': %s", filename, e)
+                    continue
+                if not repos:
+                    logger.debug("no valid repository in '%s'", filename)
+                self._repository_map.update(repos)
+            _sources_cache.save()
+        return self._repository_map
 
     def __contains__(self, key: str) -> bool:
         """Magic method for checking presence of repo in mapping."""
-        return key in self._repository_map
+        return key in self._repositories
 
     def __len__(self) -> int:
         """Return number of repositories in map."""
-        return len(self._repository_map)
+        return len(self._repositories)
 
     def __iter__(self) -> Iterable[DebianRepository]:
         """Iterator magic method for RepositoryMapping."""
-        return iter(self._repository_map.values())
+        return iter(self._repositories.values())
 
     def __getitem__(self, repository_uri: str) -> DebianRepository:
         """Return a given `DebianRepository`."""
-        return self._repository_map[repository_uri]
+        return self._repositories[repository_uri]
 
     def __setitem__(self, repository_uri: str, repository: DebianRepository) -> None:
         """Add a `DebianRepository` to the cache."""
-        self._repository_map[repository_uri] = repository
+        self._repositories[repository_uri] = repository
 
     def load(self, filename: str):
         """Load a repository source file into the cache.
 
         Args:
-          filename: the path to the repository file
+          filename: the path to the repository file, a one-line `.list` file or a deb822
+            `.sources` file
+
+        Raises:
+          InvalidSourceError if the file defines no valid repository
         """
-        parsed = []
-        skipped = []
+        repos = self._read(filename)
+        _sources_cache.save()
+        if not repos:
+            raise InvalidSourceError("all repository lines in '{}' were invalid!".format(filename))
+        self._repositories.update(repos)
+
+    @contextlib.contextmanager
+    def transaction(self, update_cache: Optional[bool] = True) -> Iterator[RepositoryTransaction]:
+        """Queue several changes to the repository files, applied when the block exits.
+
+        Nothing is written if the block raises.
+
+        Typical usage:
+
+            with apt.RepositoryMapping().transaction() as txn:
+                txn.add(new_repo)
+                txn.disable(old_repo)
+
+        Args:
+          update_cache: whether to refresh the indexes of the added repositories, with a
+            single targeted `apt-get update`
+        """
+        txn = RepositoryTransaction(self)
+        yield txn
+        txn.commit(update_cache=update_cache)
+
+    @staticmethod
+    def _read_content(filename: str) -> str:
+        """Return the content of a repository file, or an empty string if there is none."""
+        try:
+            with open(filename, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    @classmethod
+    def _read(cls, filename: str) -> Dict[str, DebianRepository]:
+        """Return the repositories defined in a file, parsing it only if it changed."""
+        st = os.stat(filename)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        cached = _sources_cache.lookup(filename, stamp)
+        if cached is not None:
+            return cached
+
         with open(filename, "r") as f:
-            for n, line in enumerate(f):
-                try:
-                    repo = self._parse(line, filename)
-                except InvalidSourceError:
-                    skipped.append(n)
-                else:
-                    repo_identifier = "{}-{}-{}".format(repo.repotype, repo.uri, repo.release)
-                    self._repository_map[repo_identifier] = repo
-                    parsed.append(n)
-                    logger.debug("parsed repo: '%s'", repo_identifier)
+            content = f.read()
+        if filename.endswith(".sources"):
+            repos = cls._parse_deb822(content, filename)
+        else:
+            repos = cls._parse_lines(content, filename)
+        logger.info("parsed %d apt package repositories from '%s'", len(repos), filename)
+
+        _sources_cache.record(filename, stamp, repos)
+        return repos
+
+    @classmethod
+    def _parse_lines(cls, content: str, filename: str) -> Dict[str, DebianRepository]:
+        """Parse the content of a one-line style `.list` file."""
+        repos = {}
+        skipped = []
+        for n, line in enumerate(content.splitlines()):
+            try:
+                repo = cls._parse(line, filename)
+            except InvalidSourceError:
+                skipped.append(n)
+            else:
+                repo_identifier = "{}-{}-{}".format(repo.repotype, repo.uri, repo.release)
+                repos[repo_identifier] = repo
+                logger.debug("parsed repo: '%s'", repo_identifier)
 
         if skipped:
             skip_list = ", ".join(str(s) for s in skipped)
             logger.debug("skipped the following lines in file '%s': %s", filename, skip_list)
+        return repos
 
-        if parsed:
-            logger.info("parsed %d apt package repositories", len(parsed))
-        else:
-            raise InvalidSourceError("all repository lines in '{}' were invalid!".format(filename))
+    @staticmethod
+    def _deb822_stanzas(content: str) -> Iterator[Dict[str, str]]:
+        """Yield the fields of each stanza of a deb822 file, keyed by lowercase name."""
+        fields: Dict[str, str] = {}
+        key = None
+        for line in content.splitlines():
+            if line.startswith("#"):
+                continue
+            if not line.strip():
+                if fields:
+                    yield fields
+                fields, key = {}, None
+            elif line[0] in " \t":
+                # continuation of a multiline field, such as an inline key
+                if key is not None:
+                    value = line.strip()
+                    fields[key] += "\n" + ("" if value == "." else value)
+            else:
+                name, sep, value = line.partition(":")
+                if not sep:
+                    continue
+                key = name.strip().lower()
+                fields[key] = value.strip()
+        if fields:
+            yield fields
+
+    @classmethod
+    def _parse_deb822(cls, content: str, filename: str) -> Dict[str, DebianRepository]:
+        """Parse the content of a deb822 style `.sources` file.
+
+        Each stanza defines a repository for every combination of its types, URIs and
+        suites.
+        """
+        repos = {}
+        for n, fields in enumerate(cls._deb822_stanzas(content)):
+            types = [t for t in fields.pop("types", "").split() if t in VALID_SOURCE_TYPES]
+            uris = fields.pop("uris", "").split()
+            suites = fields.pop("suites", "").split()
+            if not (types and uris and suites):
+                logger.debug("skipped invalid stanza %d in file '%s'", n, filename)
+                continue
+            enabled = fields.pop("enabled", "yes").lower() not in ("no", "false", "0")
+            groups = fields.pop("components", "").split()
+            gpg_key = fields.pop("signed-by", "")
+            if "\n" in gpg_key:
+                # an inline key rather than the path of a keyring
+                gpg_key = ""
+            options = {DEB822_OPTIONS.get(k, k): ",".join(v.split()) for k, v in fields.items()}
+
+            for repotype, uri, suite in itertools.product(types, uris, suites):
+                repo = DebianRepository(
+                    enabled, repotype, uri, suite, groups, filename, gpg_key, dict(options)
+                )
+                repo_identifier = "{}-{}-{}".format(repotype, uri, suite)
+                repos[repo_identifier] = repo
+                logger.debug("parsed repo: '%s'", repo_identifier)
+        return repos
 
     @staticmethod
     def _parse(line: str, filename: str) -> DebianRepository:
@@ -1283,47 +2642,25 @@ class RepositoryMapping(Mapping):
             raise InvalidSourceError("An invalid sources line was found in %s!", filename)
 
     def add(self, repo: DebianRepository, default_filename: Optional[bool] = False) -> None:
-        """Add a new repository to the system.
+        """Add a new repository to the system, or replace its entry in `repo.filename`.
+
+        The entry is written in the syntax of the file, a deb822 stanza for a `.sources`
+        file. Use `transaction` to change several repositories with a single write per file.
 
         Args:
           repo: a `DebianRepository` object
           default_filename: an (Optional) filename if the default is not desirable
         """
-        new_filename = "{}-{}.list".format(
-            DebianRepository.prefix_from_uri(repo.uri), repo.release.replace("/", "-")
-        )
-
-        fname = repo.filename or new_filename
-
-        options = repo.options if repo.options else {}
-        if repo.gpg_key:
-            options["signed-by"] = repo.gpg_key
-
-        with open(fname, "wb") as f:
-            f.write(
-                (
-                    "{}".format("#" if not repo.enabled else "")
-                    + "{} {}{} ".format(repo.repotype, repo.make_options_string(), repo.uri)
-                    + "{} {}\n".format(repo.release, " ".join(repo.groups))
-                ).encode("utf-8")
-            )
-
-        self._repository_map["{}-{}-{}".format(repo.repotype, repo.uri, repo.release)] = repo
+        with self.transaction(update_cache=False) as txn:
+            txn.add(repo)
 
     def disable(self, repo: DebianRepository) -> None:
         """Remove a repository. Disable by default.
 
+        Use `transaction` to disable several repositories with a single write per file.
+
         Args:
           repo: a `DebianRepository` to disable
         """
-        searcher = "{} {}{} {}".format(
-            repo.repotype, repo.make_options_string(), repo.uri, repo.release
-        )
-
-        for line in fileinput.input(repo.filename, inplace=True):
-            if re.match(r"^{}\s".format(re.escape(searcher)), line):
-                print("# {}".format(line), end="")
-            else:
-                print(line, end="")
-
-        self._repository_map["{}-{}-{}".format(repo.repotype, repo.uri, repo.release)] = repo
+        with self.transaction(update_cache=False) as txn:
+            txn.disable(repo)
@@ -32,22 +32,54 @@ if not service_running("mysql"):
 
 # Attempt to reload a service, restarting if necessary
 success = service_reload("nginx", restart_on_failure=True)
+
+# The same, telling which of the two happened
+if service_reload_or_restart("nginx") == "restart":
+    logger.info("nginx was restarted")
+```
+
+The state of several units can be queried with a single `systemctl show` call. The result is
+cached until the library itself changes a unit, or `refresh=True` is passed:
+```python
+states = service_states(["lldpd", "snmpd"])
+if states["lldpd"].running and not states["snmpd"].enabled:
+    ...
+```
+
+Every action accepts a list of units, which are handled by a single systemctl call. A job
+started with `service_job` runs in the background until it is waited on:
+```python
+service_restart(["lldpd", "snmpd"])
+
+job = service_job("restart", "lldpd")
+...  # meanwhile, reconfigure the interfaces
+success = job.wait()
 ```
 
 """
 
+import json
 import logging
+import os
 import subprocess
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 __all__ = [  # Don't export `_systemctl`. (It's not the intended way of using this lib.)
+    "SystemdError",
+    "SystemdJob",
+    "UnitState",
     "service_pause",
     "service_reload",
+    "service_reload_or_restart",
     "service_restart",
     "service_resume",
     "service_running",
     "service_start",
     "service_stop",
+    "service_job",
     "daemon_reload",
+    "service_state",
+    "service_states",
 ]
 
 logger = logging.getLogger(__name__)
@@ -60,127 +92,473 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 7
+
+# The properties of a unit queried by `service_states`, in the order of `UnitState`
+UNIT_PROPERTIES = (
+    "LoadState",
+    "ActiveState",
+    "SubState",
+    "UnitFileState",
+    "CanReload",
+    "MainPID",
+    "FragmentPath",
+    "DropInPaths",
+)
+
+# Whether units can be reloaded, kept on a tmpfs so that it is forgotten at reboot
+CAN_RELOAD_CACHE = "/run/charm-systemd-can-reload.json"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+
+class SystemdError(Exception):
+    """Raised when systemd cannot be queried."""
+
+
+class UnitState(NamedTuple):
+    """A snapshot of the state of a systemd unit, as reported by `systemctl show`."""
+
+    name: str
+    load_state: str
+    active_state: str
+    sub_state: str
+    unit_file_state: str
+    can_reload: bool
+    main_pid: int
+    fragment_path: str = ""
+    drop_in_paths: Tuple[str, ...] = ()
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the unit exists and was loaded by systemd."""
+        return self.load_state == "loaded"
+
+    @property
+    def running(self) -> bool:
+        """Whether the unit is active, the same way `systemctl is-active` tells."""
+        return self.active_state in ("active", "reloading")
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the unit is started at boot."""
+        return self.unit_file_state in ("enabled", "enabled-runtime", "static", "alias")
+
+    @property
+    def masked(self) -> bool:
+        """Whether the unit is masked."""
+        return self.unit_file_state in ("masked", "masked-runtime")
+
+
+# Unit states queried during this hook, until the library changes a unit
+_unit_states: Dict[str, UnitState] = {}
 
 
 def _popen_kwargs():
     return dict(
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        bufsize=1,
         universal_newlines=True,
         encoding="utf-8",
     )
 
 
-def _systemctl(
-    sub_cmd: str, service_name: str = None, now: bool = None, quiet: bool = None
-) -> bool:
-    """Control a system service.
+def _unit_names(service_name: Union[str, Iterable[str], None]) -> List[str]:
+    if service_name is None:
+        return []
+    if isinstance(service_name, str):
+        return [service_name]
+    return list(service_name)
 
-    Args:
-        sub_cmd: the systemctl subcommand to issue
-        service_name: the name of the service to perform the action on
-        now: passes the --now flag to the shell invocation.
-        quiet: passes the --quiet flag to the shell invocation.
+
+class SystemdJob:
+    """A systemctl invocation running in the background.
+
+    Returned by `service_job`. The command runs while the charm does other work, and
+    `wait` collects its result.
     """
-    cmd = ["systemctl", sub_cmd]
 
-    if service_name is not None:
-        cmd.append(service_name)
+    def __init__(self, cmd: List[str]):
+        self.cmd = cmd
+        self.output = None  # type: Optional[str]
+        self.returncode = None  # type: Optional[int]
+        if cmd[1] != "is-active":
+            # the units, or with daemon-reload every unit, are about to change
+            _unit_states.clear()
+        self._proc = subprocess.Popen(cmd, **_popen_kwargs())
+
+    @property
+    def done(self) -> bool:
+        """Whether systemctl has exited."""
+        return self.returncode is not None or self._proc.poll() is not None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for systemctl to exit and return whether it succeeded.
+
+        Args:
+            timeout: seconds to wait for, raising `subprocess.TimeoutExpired` when they
+              run out; the job keeps running and can be waited on again.
+        """
+        if self.returncode is None:
+            output, _ = self._proc.communicate(timeout=timeout)
+            if output:
+                logger.debug(output.rstrip())
+            self.output = output
+            self.returncode = self._proc.returncode
+            if self.cmd[1] != "is-active":
+                _unit_states.clear()
+        return self.returncode == 0
+
+
+def _start_systemctl(
+    sub_cmd: str,
+    service_name: Union[str, Iterable[str], None] = None,
+    now: bool = None,
+    quiet: bool = None,
+) -> SystemdJob:
+    names = _unit_names(service_name)
+    cmd = ["systemctl", sub_cmd] + names
+
     if now is not None:
         cmd.append("--now")
     if quiet is not None:
         cmd.append("--quiet")
     if sub_cmd != "is-active":
-        logger.debug("Attempting to {} '{}' with command {}.".format(cmd, service_name, cmd))
+        logger.debug("Attempting to {} '{}' with command {}.".format(sub_cmd, names, cmd))
     else:
-        logger.debug("Checking if '{}' is active".format(service_name))
+        logger.debug("Checking if '{}' is active".format(names))
+    return SystemdJob(cmd)
 
-    proc = subprocess.Popen(cmd, **_popen_kwargs())
-    for line in iter(proc.stdout.readline, ""):
-        logger.debug(line)
 
-    proc.wait()
-    return proc.returncode == 0
+def _systemctl(
+    sub_cmd: str,
+    service_name: Union[str, Iterable[str], None] = None,
+    now: bool = None,
+    quiet: bool = None,
+) -> bool:
+    """Control one or more system services.
+
+    Args:
+        sub_cmd: the systemctl subcommand to issue
+        service_name: the name of the service, or services, to perform the action on
+        now: passes the --now flag to the shell invocation.
+        quiet: passes the --quiet flag to the shell invocation.
+    """
+    return _start_systemctl(sub_cmd, service_name, now=now, quiet=quiet).wait()
+
+
+def _parse_unit_state(name: str, properties: Dict[str, str]) -> UnitState:
+    try:
+        main_pid = int(properties.get("MainPID") or 0)
+    except ValueError:
+        main_pid = 0
+    return UnitState(
+        name=name,
+        load_state=properties.get("LoadState", ""),
+        active_state=properties.get("ActiveState", ""),
+        sub_state=properties.get("SubState", ""),
+        unit_file_state=properties.get("UnitFileState", ""),
+        can_reload=properties.get("CanReload") == "yes",
+        main_pid=main_pid,
+        fragment_path=properties.get("FragmentPath", ""),
+        drop_in_paths=tuple(properties.get("DropInPaths", "").split()),
+    )
 
 
-def service_running(service_name: str) -> bool:
-    """Determine whether a system service is running.
+def service_states(service_names: Iterable[str], refresh: bool = False) -> Dict[str, UnitState]:
+    """Return the state of several system services, queried with one `systemctl show`.
+
+    The states are cached until the library starts, stops, reloads or otherwise changes a
+    unit, so asking again during the same hook costs nothing.
+
+    Args:
+        service_names: the names of the services
+        refresh: whether to query systemd even if the states are cached
+
+    Raises:
+        SystemdError if systemctl fails
+    """
+    names = list(dict.fromkeys(service_names))
+    missing = [n for n in names if refresh or n not in _unit_states]
+    if missing:
+        cmd = ["systemctl", "show", "--property={}".format(",".join(UNIT_PROPERTIES)), *missing]
+        logger.debug("Querying the state of %s", ", ".join(missing))
+        proc = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            encoding="utf-8",
+        )
+        if proc.returncode != 0:
+            raise SystemdError("Could not query {}: {}".format(missing, proc.stderr.strip()))
+
+        # one block of properties per unit, in the order they were asked for
+        blocks = [{}]
+        for line in proc.stdout.splitlines():
+            if not line.strip():
+                if blocks[-1]:
+                    blocks.append({})
+                continue
+            key, _, value = line.partition("=")
+            blocks[-1][key] = value
+        for name, properties in zip(missing, blocks):
+            _unit_states[name] = _parse_unit_state(name, properties)
+
+    return {n: _unit_states[n] for n in names}
+
+
+def service_state(service_name: str, refresh: bool = False) -> UnitState:
+    """Return the state of a system service.
 
     Args:
         service_name: the name of the service
+        refresh: whether to query systemd even if the state is cached
+
+    Raises:
+        SystemdError if systemctl fails
     """
-    return _systemctl("is-active", service_name, quiet=True)
+    return service_states([service_name], refresh=refresh)[service_name]
 
 
-def service_start(service_name: str) -> bool:
+def service_running(service_name: Union[str, Iterable[str]]) -> bool:
+    """Determine whether a system service, or all of several, is running.
+
+    The answer comes from the same cache as `service_state`.
+
+    Args:
+        service_name: the name of the service, or a list of names
+    """
+    names = _unit_names(service_name)
+    try:
+        states = service_states(names)
+    except SystemdError as e:
+        logger.debug(e)
+        return False
+    return all(states[name].running for name in names)
+
+
+def service_start(service_name: Union[str, Iterable[str]]) -> bool:
     """Start a system service.
 
     Args:
-        service_name: the name of the service to stop
+        service_name: the name of the service to start, or a list of names to start with
+          a single systemctl call
     """
     return _systemctl("start", service_name)
 
 
-def service_stop(service_name: str) -> bool:
+def service_stop(service_name: Union[str, Iterable[str]]) -> bool:
     """Stop a system service.
 
     Args:
-        service_name: the name of the service to stop
+        service_name: the name of the service to stop, or a list of names to stop with
+          a single systemctl call
     """
     return _systemctl("stop", service_name)
 
 
-def service_restart(service_name: str) -> bool:
+def service_restart(service_name: Union[str, Iterable[str]]) -> bool:
     """Restart a system service.
 
     Args:
-        service_name: the name of the service to restart
+        service_name: the name of the service to restart, or a list of names to restart
+          with a single systemctl call
     """
     return _systemctl("restart", service_name)
 
 
-def service_reload(service_name: str, restart_on_failure: bool = False) -> bool:
-    """Reload a system service, optionally falling back to restart if reload fails.
+def service_job(action: str, service_name: Union[str, Iterable[str]]) -> SystemdJob:
+    """Run a systemctl action on services without waiting for it to complete.
+
+    ```python
+    job = service_job("restart", ["lldpd", "snmpd"])
+    reconfigure_interfaces()
+    if not job.wait():
+        logger.error("restart failed: %s", job.output)
+    ```
+
+    Args:
+        action: the systemctl subcommand, such as "start", "stop", "restart" or "reload"
+        service_name: the name of the service, or a list of names
+    """
+    return _start_systemctl(action, service_name)
+
+
+def _unit_files_stamp(state: UnitState) -> Dict[str, Optional[List[int]]]:
+    """Return the (mtime_ns, size, inode) of the unit file and drop-ins of a unit."""
+    stamp = {}
+    for path in filter(None, (state.fragment_path, *state.drop_in_paths)):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamp[path] = None
+        else:
+            stamp[path] = [st.st_mtime_ns, st.st_size, st.st_ino]
+    return stamp
+
+
+def _is_fresh(entry) -> bool:
+    """Whether none of the files a cached reload capability was read from changed."""
+    if not isinstance(entry, dict) or not isinstance(entry.get("files"), dict):
+        return False
+    for path, stamp in entry["files"].items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            current = None
+        else:
+            current = [st.st_mtime_ns, st.st_size, st.st_ino]
+        if current != stamp:
+            return False
+    return True
+
+
+def _read_can_reload() -> Dict[str, dict]:
+    """Return the cached reload capabilities of units, if they were cached during this boot.
+
+    A unit whose unit file or drop-ins changed since, for instance when a package upgrade
+    replaced them and reloaded systemd itself, is left out.
+    """
+    try:
+        with open(BOOT_ID) as f:
+            boot_id = f.read().strip()
+        with open(CAN_RELOAD_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("boot_id") != boot_id:
+        return {}
+    units = cache.get("units", {})
+    return {name: entry for name, entry in units.items() if _is_fresh(entry)}
+
+
+def _write_can_reload(units: Dict[str, dict]) -> None:
+    try:
+        with open(BOOT_ID) as f:
+            boot_id = f.read().strip()
+        tmp = "{}.{}".format(CAN_RELOAD_CACHE, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"boot_id": boot_id, "units": units}, f)
+        os.replace(tmp, CAN_RELOAD_CACHE)
+    except OSError as e:
+        logger.debug("Could not cache the reload capabilities: %s", e)
+
+
+def _can_reload(service_names: List[str]) -> Dict[str, bool]:
+    """Return whether units can be reloaded, asking systemd once per boot and unit file."""
+    units = _read_can_reload()
+    missing = [name for name in service_names if name not in units]
+    if missing:
+        states = service_states(missing)
+        for name in missing:
+            units[name] = {
+                "can_reload": states[name].can_reload,
+                "files": _unit_files_stamp(states[name]),
+            }
+        _write_can_reload(units)
+    return {name: units[name]["can_reload"] for name in service_names}
+
+
+def service_reload_or_restart(service_name: str) -> Optional[str]:
+    """Reload a system service, or restart it when it cannot be reloaded.
+
+    Whether the unit can be reloaded, its `CanReload` property, is checked once per boot
+    and version of the unit file, so a unit without `ExecReload` is restarted without
+    trying to reload it first.
 
     Args:
         service_name: the name of the service to reload
-        restart_on_failure: boolean indicating whether to fallback to a restart if the
-          reload fails.
+
+    Returns:
+        "reload" or "restart", whichever was done, or None if both failed
     """
-    service_result = _systemctl("reload", service_name)
-    if not service_result and restart_on_failure:
-        service_result = _systemctl("restart", service_name)
-    return service_result
+    try:
+        can_reload = _can_reload([service_name])[service_name]
+    except SystemdError as e:
+        logger.debug(e)
+        can_reload = True
+    if can_reload:
+        if _systemctl("reload", service_name):
+            return "reload"
+    else:
+        logger.debug("'%s' cannot be reloaded, restarting it", service_name)
+    if _systemctl("restart", service_name):
+        return "restart"
+    return None
 
 
-def service_pause(service_name: str) -> bool:
-    """Pause a system service.
+def service_reload(
+    service_name: Union[str, Iterable[str]], restart_on_failure: bool = False
+) -> bool:
+    """Reload a system service, optionally falling back to restart if reload fails.
 
-    Stop it, and prevent it from starting again at boot.
+    A unit known not to support reloading, see `service_reload_or_restart`, is not asked
+    to reload. Several units are reloaded with a single systemctl call, and those which
+    need it restarted with another.
 
     Args:
-        service_name: the name of the service to pause
+        service_name: the name of the service to reload, or a list of names
+        restart_on_failure: boolean indicating whether to fallback to a restart if the
+          reload fails.
     """
-    _systemctl("disable", service_name, now=True)
-    _systemctl("mask", service_name)
-    return not service_running(service_name)
+    names = _unit_names(service_name)
+    if restart_on_failure and len(names) == 1:
+        return service_reload_or_restart(names[0]) is not None
+    try:
+        can_reload = _can_reload(names)
+    except SystemdError as e:
+        logger.debug(e)
+        can_reload = dict.fromkeys(names, True)
+    reloadable = [name for name in names if can_reload[name]]
+    others = [name for name in names if not can_reload[name]]
+    if others:
+        logger.debug("%s cannot be reloaded", others)
+    if reloadable and not _systemctl("reload", reloadable):
+        # systemctl does not tell which of the units failed
+        others += reloadable
+    if not others:
+        return True
+    return restart_on_failure and _systemctl("restart", others)
+
+
+def service_pause(service_name: Union[str, Iterable[str]]) -> bool:
+    """Pause a system service.
 
+    Stop it, and prevent it from starting again at boot.
 
-def service_resume(service_name: str) -> bool:
+    Args:
+        service_name: the name of the service to pause, or a list of names
+    """
+    names = _unit_names(service_name)
+    _systemctl("disable", names, now=True)
+    _systemctl("mask", names)
+    try:
+        states = service_states(names)
+    except SystemdError as e:
+        logger.debug(e)
+        return False
+    return not any(states[name].running for name in names)
+
+
+def service_resume(service_name: Union[str, Iterable[str]]) -> bool:
     """Resume a system service.
 
     Re-enable starting again at boot. Start the service.
 
     Args:
-        service_name: the name of the service to resume
+        service_name: the name of the service to resume, or a list of names
     """
-    _systemctl("unmask", service_name)
-    _systemctl("enable", service_name, now=True)
-    return service_running(service_name)
+    names = _unit_names(service_name)
+    _systemctl("unmask", names)
+    _systemctl("enable", names, now=True)
+    return service_running(names)
 
 
 def daemon_reload() -> bool:
     """Reload systemd manager configuration."""
+    # unit files may have gained or lost their ExecReload
+    try:
+        os.remove(CAN_RELOAD_CACHE)
+    except OSError:
+        pass
     return _systemctl("daemon-reload")
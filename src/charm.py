@@ -17,27 +17,226 @@
 
 """Main Charm module."""
 
+import hashlib
 import logging
 import os
+import re
 import subprocess
 import shutil
+import tarfile
+import tempfile
+import time
 
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError
 from charms.operator_libs_linux.v0 import apt
-from charms.operator_libs_linux.v0.systemd import service_reload
+from lldpctl import LLDPD_SOCKET, socket_error
+from charms.operator_libs_linux.v0.systemd import (
+    SystemdError,
+    daemon_reload,
+    service_restart,
+    service_state,
+)
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 PACKAGES = ["lldpd"]
+# An index refreshed by anything on the machine within this many seconds is reused
+APT_UPDATE_MAX_AGE = 600
+# Optional tarball of .deb files, in one directory per platform such as ubuntu-22.04-amd64/
+DEB_RESOURCE = "lldpd-debs"
+OS_RELEASE = "/etc/os-release"
+# Seconds to wait for lldpd to be ready, and the bounds of the delay between checks
+READY_TIMEOUT = 30
+READY_MIN_DELAY = 0.001
+READY_MAX_DELAY = 0.25
 PATHS = {
     "lldpddef": "/etc/default/lldpd",
     "lldpdconf": "/etc/lldpd.conf",
+    "lldpdd": "/etc/lldpd.d/50-charm.conf",
+    "dropin": "/etc/systemd/system/lldpd.service.d/50-charm-resources.conf",
 }
+# The config options rendered in the drop-in, their directive and accepted values
+RESOURCE_CONTROLS = {
+    "cpu-quota": ("CPUQuota", r"\d+%"),
+    "cpu-weight": ("CPUWeight", r"[1-9]\d{0,3}|10000"),
+    "memory-max": ("MemoryMax", r"\d+[KMGT]?|\d+%|infinity"),
+    "nice": ("Nice", r"-?1?\d|-20"),
+    "io-scheduling-class": ("IOSchedulingClass", r"realtime|best-effort|idle"),
+    "allowed-cpus": ("AllowedCPUs", r"\d+(-\d+)?(,\d+(-\d+)?)*"),
+}
+# The lldpcli statements setting and unsetting each setting applied to the running lldpd
+SETTINGS = {
+    "hostname": ("configure system hostname {}", "unconfigure system hostname"),
+    "description": (
+        "configure system description {}",
+        "unconfigure system description",
+    ),
+}
+# The only content of /etc/lldpd.conf as written by earlier versions of the charm
+CHARM_LLDPD_CONF = re.compile(r"configure system hostname (\S+)\n")
 logger = logging.getLogger(__name__)
 
 
+def read_file(path: str) -> Optional[str]:
+    """Return the content of a file, or None if it does not exist."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_file(path: str, content: str) -> bool:
+    """Write content to a file unless it already holds it.
+
+    Returns:
+        True if the file was written, False if it was already up to date.
+    """
+    if read_file(path) == content:
+        return False
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+
+def remove_file(path: str) -> bool:
+    """Remove a file if it exists.
+
+    Returns:
+        True if the file was removed, False if it did not exist.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def settings_statements(applied: Dict[str, str], settings: Dict[str, str]) -> List[str]:
+    """Return the lldpcli statements changing the applied settings into new ones."""
+    statements = [SETTINGS[key][1] for key in sorted(applied) if key not in settings]
+    for key, value in sorted(settings.items()):
+        if applied.get(key) != value:
+            statements.append(SETTINGS[key][0].format(value))
+    return statements
+
+
+def lldpcli(statements: List[str]) -> bool:
+    """Run lldpcli statements in a single session.
+
+    Returns:
+        True if lldpcli succeeded.
+    """
+    try:
+        subprocess.run(
+            ["lldpcli", "-c", "/dev/stdin"],
+            input="".join(statement + "\n" for statement in statements),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logger.warning("lldpcli failed: %s", e.output.strip())
+        return False
+    except OSError as e:
+        logger.warning("Could not run lldpcli: %s", e)
+        return False
+    return True
+
+
+def fingerprint(files: Dict[str, str]) -> str:
+    """Return a stable digest of rendered configuration files."""
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(path.encode())
+        digest.update(b"\0")
+        digest.update(files[path].encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def platform_name(arch: str) -> str:
+    """Return the name of the platform of this machine, e.g. ubuntu-22.04-amd64."""
+    release = {}
+    for line in (read_file(OS_RELEASE) or "").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            release[key] = value.strip().strip('"')
+    return "{}-{}-{}".format(
+        release.get("ID", "ubuntu"), release.get("VERSION_ID", ""), arch
+    )
+
+
+def extract_debs(tarball: str, platform: str, dest: str) -> List[str]:
+    """Extract the .deb files of a platform from a resource tarball.
+
+    Returns:
+        The paths of the extracted files.
+    """
+    debs = []
+    with tarfile.open(tarball) as tar:
+        for member in tar.getmembers():
+            name = os.path.normpath(member.name)
+            if not member.isfile() or not name.endswith(".deb"):
+                continue
+            if os.path.dirname(name) != platform:
+                continue
+            path = os.path.join(dest, os.path.basename(name))
+            with tar.extractfile(member) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            debs.append(path)
+    return debs
+
+
+def deb_fields(path: str) -> Tuple[str, str]:
+    """Return the package name and version of a .deb file."""
+    output = subprocess.check_output(
+        ["dpkg-deb", "--show", "--showformat=${Package} ${Version}", path],
+        universal_newlines=True,
+    )
+    name, version = output.split()
+    return name, version
+
+
+def wait_for_lldpd(timeout: float = READY_TIMEOUT) -> Optional[str]:
+    """Wait until lldpd is active and accepts connections on its control socket.
+
+    The first check is immediate and the delay between checks doubles from a
+    millisecond, so a daemon which comes up promptly is only waited on briefly.
+
+    Returns:
+        None once lldpd is ready, or why it is not if it failed or the timeout ran out.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = READY_MIN_DELAY
+    while True:
+        try:
+            state = service_state("lldpd", refresh=True)
+        except SystemdError as e:
+            reason = str(e)
+        else:
+            if not state.loaded:
+                return "lldpd unit is {}".format(state.load_state)
+            if state.active_state == "failed":
+                return "lldpd is {} ({})".format(state.active_state, state.sub_state)
+            reason = "lldpd is {}".format(state.active_state)
+            if state.active_state == "active":
+                reason = socket_error(LLDPD_SOCKET)
+                if reason is None:
+                    logger.info("lldpd ready after %.3fs", time.monotonic() - start)
+                    return None
+        now = time.monotonic()
+        if now >= deadline:
+            return "{} after {:g}s".format(reason, timeout)
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, READY_MAX_DELAY)
+
+
 class LldpdCharm(CharmBase):
     """Charm to deploy and manage lldpd"""
 
@@ -45,6 +244,13 @@ class LldpdCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
+        self.state.set_default(applied_fingerprints={}, applied_settings={})
+        # lldpd is restarted at most once per dispatch, see on_pre_commit
+        self._restart_queued = False
+        self._queued_fingerprints = {}  # type: Dict[str, str]
+        self._queued_settings = None  # type: Optional[Dict[str, str]]
+        self._configured = False
+        self.framework.observe(self.framework.on.pre_commit, self.on_pre_commit)
         self.framework.observe(self.on.install, self.on_upgrade_charm)
         self.framework.observe(self.on.upgrade_charm, self.on_upgrade_charm)
         self.framework.observe(self.on.config_changed, self.on_config_changed)
@@ -78,8 +284,69 @@ class LldpdCharm(CharmBase):
         # TODO get this working for config-changed, but only if relation exists
 
     def install(self):
-        apt.update()
-        apt.add_package(PACKAGES)
+        """Install the packages, refreshing the apt index only if needed."""
+        if self.install_from_resource(apt.inventory()):
+            return
+        # read again, the resource may have been partly installed
+        installed = apt.inventory()
+        missing = [p for p in PACKAGES if p not in installed]
+        if not missing:
+            logger.info("Packages already installed: %s", ", ".join(PACKAGES))
+            return
+        apt.update(max_age=APT_UPDATE_MAX_AGE, progress=self.report_progress)
+        apt.add_package(missing, progress=self.report_progress)
+
+    def install_from_resource(self, installed: apt.PackageInventory) -> bool:
+        """Install the packages with apt from the deb resource, if it is attached.
+
+        Returns:
+            True if the packages of the resource are installed, False if apt should be
+            used instead.
+        """
+        try:
+            resource = self.model.resources.fetch(DEB_RESOURCE)
+        except (ModelError, NameError):
+            return False
+        if resource.stat().st_size == 0:
+            return False
+
+        platform = platform_name(installed.arch)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                debs = extract_debs(str(resource), platform, tmpdir)
+            except tarfile.TarError as e:
+                logger.warning("Ignoring the %s resource: %s", DEB_RESOURCE, e)
+                return False
+
+            pending = []
+            provided = set()
+            for deb in debs:
+                try:
+                    name, version = deb_fields(deb)
+                except (subprocess.CalledProcessError, ValueError) as e:
+                    logger.warning("Ignoring the %s resource: %s", DEB_RESOURCE, e)
+                    return False
+                provided.add(name)
+                if name not in installed or installed[name].fullversion != version:
+                    pending.append(deb)
+            if not all(p in provided for p in PACKAGES):
+                logger.info("No %s packages for %s in the resource", PACKAGES, platform)
+                return False
+            if not pending:
+                logger.info("Packages already at the version of the resource")
+                return True
+
+            self.report_progress("Installing packages from the resource")
+            try:
+                apt.add_deb_files(pending, progress=self.report_progress)
+            except apt.PackageError as e:
+                logger.warning("Could not install the resource packages: %s", e)
+                return False
+        return True
+
+    def report_progress(self, message: str):
+        """Show the progress of a long running operation in the unit status."""
+        self.unit.status = MaintenanceStatus(message)
 
     @property
     def machine_id(self):
@@ -88,12 +355,97 @@ class LldpdCharm(CharmBase):
     def configure(self):
         """Base config-changed hook."""
         config = self.model.config
+        try:
+            resource_controls = self.render_resource_controls()
+        except ValueError as e:
+            logger.error("Not configuring lldpd: %s", e)
+            self.unit.status = BlockedStatus(str(e))
+            return
 
         # handle the side effects first
         if config["i40e-lldp-stop"]:
             self.disable_i40e_lldp()
-        if config["short-name"]:
-            self.update_short_name()
+
+        # Restarting lldpd drops every learned neighbor, so only do it when the
+        # options which lldpd reads when it starts differ from what was applied.
+        path = PATHS["lldpddef"]
+        daemon_args = self.render_daemon_args()
+        changed = write_file(path, daemon_args)
+        digest = fingerprint({path: daemon_args})
+        if changed or digest != self.state.applied_fingerprints.get(path):
+            self.queue_restart({path: digest})
+
+        # The other settings are applied to the running lldpd, and kept in a drop-in
+        # which lldpd reads when it starts.
+        self.migrate_lldpd_conf()
+        settings = self.render_settings()
+        self.update_settings(settings)
+        self._queued_settings = settings
+
+        # systemd is reloaded before the restart when the drop-in differs from what
+        # was applied, no drop-in at all having been applied before the first hook
+        path = PATHS["dropin"]
+        changed = self.update_resource_controls(resource_controls)
+        digest = fingerprint({path: resource_controls})
+        applied = self.state.applied_fingerprints.get(path, fingerprint({path: ""}))
+        if changed or digest != applied:
+            if daemon_reload():
+                self.queue_restart({path: digest})
+            else:
+                logger.warning("Could not reload systemd for %s", path)
+        if not self._restart_queued:
+            logger.info("lldpd daemon options unchanged, not restarting")
+        self._configured = True
+
+    def queue_restart(self, fingerprints: Dict[str, str]):
+        """Queue a restart of lldpd, sent when the framework commits.
+
+        Args:
+            fingerprints: the fingerprints of the changed files, recorded as applied
+              once lldpd restarted
+        """
+        self._restart_queued = True
+        self._queued_fingerprints.update(fingerprints)
+
+    def on_pre_commit(self, event):
+        """Send the queued lldpd restart, if any, and report whether lldpd is ready.
+
+        This runs once at the end of the dispatch, before the stored state is saved, so
+        however many changes were queued lldpd gets a single systemctl call.
+        """
+        restart, self._restart_queued = self._restart_queued, False
+        fingerprints, self._queued_fingerprints = self._queued_fingerprints, {}
+        settings, self._queued_settings = self._queued_settings, None
+        restarted = False
+        if restart:
+            restarted = service_restart("lldpd")
+            if restarted:
+                logger.info("lldpd restarted, its neighbor tables were dropped")
+                self.state.applied_fingerprints.update(fingerprints)
+            else:
+                # keep the old fingerprints so that the next hook tries again
+                logger.warning("Could not restart lldpd")
+
+        if settings is not None:
+            if restarted:
+                # lldpd read the drop-in when it started
+                self.state.applied_settings = settings
+            else:
+                self.apply_settings(settings)
+
+        if not self._configured:
+            return
+        self._configured = False
+        reason = wait_for_lldpd()
+        if reason is not None:
+            logger.error("lldpd is not ready: %s", reason)
+            self.unit.status = BlockedStatus("lldpd not ready: {}".format(reason))
+            return
+        self.framework.model.unit.status = ActiveStatus("ready")
+
+    def render_daemon_args(self) -> str:
+        """Render the content of /etc/default/lldpd."""
+        config = self.model.config
 
         args = []
         if config["systemid-from-interface"]:
@@ -102,13 +454,43 @@ class LldpdCharm(CharmBase):
             args.append("-I {}".format(config["interfaces-regex"]))
         if config["enable-snmp"]:
             args.append("-x")
-        if self.machine_id:
-            args.append("-S juju_machine_id={}".format(self.machine_id))
 
-        with open(PATHS["lldpddef"], "w") as conf:
-            conf.write('DAEMON_ARGS="{}"\n'.format(" ".join(args)))
-        service_reload("lldpd", restart_on_failure=True)
-        self.framework.model.unit.status = ActiveStatus("ready")
+        return 'DAEMON_ARGS="{}"\n'.format(" ".join(args))
+
+    def render_resource_controls(self) -> str:
+        """Render the systemd drop-in limiting the resources of lldpd.
+
+        Returns:
+            The content of the drop-in, empty when no limit is set.
+
+        Raises:
+            ValueError: if an option does not hold a valid value.
+        """
+        config = self.model.config
+
+        directives = []
+        for option, (directive, pattern) in RESOURCE_CONTROLS.items():
+            value = config[option].strip()
+            if not value:
+                continue
+            if not re.fullmatch(pattern, value):
+                raise ValueError("invalid {}: {!r}".format(option, value))
+            directives.append("{}={}\n".format(directive, value))
+        if not directives:
+            return ""
+        return "# Managed by the lldpd charm\n[Service]\n" + "".join(directives)
+
+    def update_resource_controls(self, content: str) -> bool:
+        """Write the resource controls drop-in, or remove it when it is empty.
+
+        Returns:
+            True if the drop-in was written or removed.
+        """
+        path = PATHS["dropin"]
+        if not content:
+            return remove_file(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return write_file(path, content)
 
     def disable_i40e_lldp(self):
         """Disable i40e."""
@@ -153,11 +535,59 @@ class LldpdCharm(CharmBase):
                 check=True,
             )
 
-    def update_short_name(self):
-        """Add system shortname to lldpd."""
-        shortname = os.uname()[1]
-        with open(PATHS["lldpdconf"], "w") as f:
-            f.write("configure system hostname {}\n".format(str(shortname)))
+    def render_settings(self) -> Dict[str, str]:
+        """Render the settings applied to the running lldpd, see SETTINGS."""
+        settings = {}
+        if self.model.config["short-name"]:
+            settings["hostname"] = os.uname()[1]
+        if self.machine_id:
+            settings["description"] = "juju_machine_id={}".format(self.machine_id)
+        return settings
+
+    def update_settings(self, settings: Dict[str, str]) -> bool:
+        """Write the settings to the charm's lldpd drop-in, or remove it if empty.
+
+        Returns:
+            True if the drop-in was written or removed.
+        """
+        path = PATHS["lldpdd"]
+        if not settings:
+            return remove_file(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        statements = settings_statements({}, settings)
+        return write_file(
+            path,
+            "# Managed by the lldpd charm\n"
+            + "".join(statement + "\n" for statement in statements),
+        )
+
+    def apply_settings(self, settings: Dict[str, str]):
+        """Change the settings of the running lldpd from the applied ones, if needed."""
+        applied = dict(self.state.applied_settings)
+        statements = settings_statements(applied, settings)
+        if not statements:
+            return
+        logger.info("Applying %s to lldpd", statements)
+        # keep the old settings on failure so that the next hook tries again
+        if lldpcli(statements):
+            self.state.applied_settings = settings
+
+    def migrate_lldpd_conf(self):
+        """Remove /etc/lldpd.conf if it was written by an earlier version of the charm.
+
+        The hostname it set is recorded as applied, to be unset if short-name is off.
+        """
+        content = read_file(PATHS["lldpdconf"])
+        match = CHARM_LLDPD_CONF.fullmatch(content or "")
+        if match is None:
+            return
+        logger.info(
+            "Moving the settings of %s to %s", PATHS["lldpdconf"], PATHS["lldpdd"]
+        )
+        remove_file(PATHS["lldpdconf"])
+        applied = dict(self.state.applied_settings)
+        applied.setdefault("hostname", match.group(1))
+        self.state.applied_settings = applied
 
     def setup_nrpe(self):
         ## FIXME use ops-lib-nrpe
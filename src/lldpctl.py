@@ -0,0 +1,327 @@
+# Copyright 2024 Canonical Ltd.
+#
+# This file is part of the lldpd charm for Juju.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Client of the lldpd control socket.
+
+The messages exchanged on the control socket are lldpd's own serialization of its C
+structures, which changes between releases. Rather than speaking it from Python, this
+module binds liblldpctl, the library lldpcli is built on, with ctypes. A `Client` keeps
+one connection to lldpd open for all its queries and configuration changes:
+
+```python
+with Client() as client:
+    for neighbor in client.neighbors():
+        print(neighbor.interface, neighbor.chassis_name, neighbor.port_id)
+    client.configure("hostname", "node1")
+```
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import socket
+from typing import Callable, Iterator, List, NamedTuple, Optional, Union
+
+LLDPD_SOCKET = "/run/lldpd.socket"
+# The soname of liblldpctl, shipped with lldpd, if ldconfig does not know it
+LIBRARY = "liblldpctl.so.4"
+
+# Values of lldpctl_key_t, from lldpctl.h
+CONFIG_KEYS = {
+    "tx-interval": 0,
+    "receive-only": 1,
+    "management-pattern": 2,
+    "interface-pattern": 3,
+    "chassis-id-pattern": 4,
+    "description": 5,
+    "platform": 6,
+    "hostname": 7,
+}
+K_INTERFACE_NAME = 1000
+K_PORT_NEIGHBORS = 1200
+K_PORT_PROTOCOL = 1201
+K_PORT_AGE = 1202
+K_PORT_ID = 1204
+K_PORT_DESCR = 1205
+K_PORT_CHASSIS = 1208
+K_CHASSIS_ID = 1702
+K_CHASSIS_NAME = 1703
+K_CHASSIS_DESCR = 1704
+
+_c_void_p = ctypes.c_void_p
+_c_char_p = ctypes.c_char_p
+# The functions of liblldpctl used by the client, with their result and argument types
+PROTOTYPES = {
+    "lldpctl_new_name": (_c_void_p, [_c_char_p, _c_void_p, _c_void_p, _c_void_p]),
+    "lldpctl_release": (ctypes.c_int, [_c_void_p]),
+    "lldpctl_last_error": (ctypes.c_int, [_c_void_p]),
+    "lldpctl_strerror": (_c_char_p, [ctypes.c_int]),
+    "lldpctl_get_configuration": (_c_void_p, [_c_void_p]),
+    "lldpctl_get_interfaces": (_c_void_p, [_c_void_p]),
+    "lldpctl_get_local_chassis": (_c_void_p, [_c_void_p]),
+    "lldpctl_get_port": (_c_void_p, [_c_void_p]),
+    "lldpctl_atom_dec_ref": (None, [_c_void_p]),
+    "lldpctl_atom_iter": (_c_void_p, [_c_void_p]),
+    "lldpctl_atom_iter_next": (_c_void_p, [_c_void_p, _c_void_p]),
+    "lldpctl_atom_iter_value": (_c_void_p, [_c_void_p, _c_void_p]),
+    "lldpctl_atom_get": (_c_void_p, [_c_void_p, ctypes.c_int]),
+    "lldpctl_atom_get_str": (_c_char_p, [_c_void_p, ctypes.c_int]),
+    "lldpctl_atom_get_int": (ctypes.c_long, [_c_void_p, ctypes.c_int]),
+    "lldpctl_atom_set_str": (_c_void_p, [_c_void_p, ctypes.c_int, _c_char_p]),
+    "lldpctl_atom_set_int": (_c_void_p, [_c_void_p, ctypes.c_int, ctypes.c_long]),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class LldpctlError(Exception):
+    """liblldpctl could not be loaded, or lldpd refused a request."""
+
+
+class Chassis(NamedTuple):
+    """A chassis, the local one or a neighbor's."""
+
+    id: str
+    name: str
+    descr: str
+
+
+class Neighbor(NamedTuple):
+    """A neighbor seen on a local interface."""
+
+    interface: str
+    protocol: str
+    age: int
+    chassis_id: str
+    chassis_name: str
+    port_id: str
+    port_descr: str
+
+
+class Port(NamedTuple):
+    """A local port and the neighbors seen on it."""
+
+    interface: str
+    port_id: str
+    port_descr: str
+    neighbors: List[Neighbor]
+
+
+def load_library(path: Optional[str] = None) -> ctypes.CDLL:
+    """Load liblldpctl and declare the prototypes of the functions the client calls.
+
+    Raises:
+        LldpctlError: if the library cannot be loaded.
+    """
+    path = path or ctypes.util.find_library("lldpctl") or LIBRARY
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError as e:
+        raise LldpctlError("Cannot load liblldpctl: {}".format(e)) from None
+    for name, (restype, argtypes) in PROTOTYPES.items():
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+    return lib
+
+
+def socket_error(path: str) -> Optional[str]:
+    """Return why a unix socket does not accept connections, or None if it does."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(path)
+    except OSError as e:
+        return "{}: {}".format(path, e.strerror or e)
+    finally:
+        sock.close()
+    return None
+
+
+def _decode(value: Optional[bytes]) -> str:
+    return value.decode("utf-8", errors="replace") if value is not None else ""
+
+
+class Client:
+    """A connection to lldpd, kept open until `close`.
+
+    Args:
+        socket_path: the control socket of lldpd
+        library: liblldpctl, or an object with the same functions, loaded if not given
+
+    Raises:
+        LldpctlError: if lldpd does not accept connections on `socket_path`.
+    """
+
+    def __init__(self, socket_path: str = LLDPD_SOCKET, library=None):
+        # liblldpctl only connects on the first request, and then only reports that it
+        # could not: say why, before loading the library at all
+        reason = socket_error(socket_path)
+        if reason is not None:
+            raise LldpctlError("Cannot connect to lldpd: {}".format(reason))
+        self._lib = library if library is not None else load_library()
+        self._conn = self._lib.lldpctl_new_name(socket_path.encode(), None, None, None)
+        if not self._conn:
+            raise LldpctlError("Cannot allocate a connection to {}".format(socket_path))
+
+    def close(self):
+        """Close the connection to lldpd."""
+        if self._conn:
+            self._lib.lldpctl_release(self._conn)
+            self._conn = None
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _error(self, what: str) -> LldpctlError:
+        code = self._lib.lldpctl_last_error(self._conn)
+        return LldpctlError(
+            "{}: {}".format(what, _decode(self._lib.lldpctl_strerror(code)))
+        )
+
+    def _atom(self, get: Callable, *args, what: str) -> int:
+        """Return the atom returned by a liblldpctl function, which must be released."""
+        atom = get(*args)
+        if not atom:
+            raise self._error(what)
+        return atom
+
+    def _values(self, atom: int) -> Iterator[int]:
+        """Iterate over the atoms of a list, each released after its iteration."""
+        lib = self._lib
+        it = lib.lldpctl_atom_iter(atom)
+        while it:
+            value = lib.lldpctl_atom_iter_value(atom, it)
+            if not value:
+                break
+            try:
+                yield value
+            finally:
+                lib.lldpctl_atom_dec_ref(value)
+            it = lib.lldpctl_atom_iter_next(atom, it)
+
+    def _str(self, atom: int, key: int) -> str:
+        return _decode(self._lib.lldpctl_atom_get_str(atom, key))
+
+    def _chassis(self, chassis: int) -> Chassis:
+        return Chassis(
+            self._str(chassis, K_CHASSIS_ID),
+            self._str(chassis, K_CHASSIS_NAME),
+            self._str(chassis, K_CHASSIS_DESCR),
+        )
+
+    def _neighbor(self, interface: str, port: int) -> Neighbor:
+        lib = self._lib
+        chassis = lib.lldpctl_atom_get(port, K_PORT_CHASSIS)
+        try:
+            neighbor_chassis = (
+                self._chassis(chassis) if chassis else Chassis("", "", "")
+            )
+        finally:
+            if chassis:
+                lib.lldpctl_atom_dec_ref(chassis)
+        return Neighbor(
+            interface,
+            self._str(port, K_PORT_PROTOCOL),
+            lib.lldpctl_atom_get_int(port, K_PORT_AGE),
+            neighbor_chassis.id,
+            neighbor_chassis.name,
+            self._str(port, K_PORT_ID),
+            self._str(port, K_PORT_DESCR),
+        )
+
+    def _port_neighbors(self, interface: str, port: int) -> List[Neighbor]:
+        lib = self._lib
+        neighbors = lib.lldpctl_atom_get(port, K_PORT_NEIGHBORS)
+        if not neighbors:
+            return []
+        try:
+            return [self._neighbor(interface, n) for n in self._values(neighbors)]
+        finally:
+            lib.lldpctl_atom_dec_ref(neighbors)
+
+    def chassis(self) -> Chassis:
+        """Return the local chassis."""
+        lib = self._lib
+        chassis = self._atom(
+            lib.lldpctl_get_local_chassis, self._conn, what="Cannot get the chassis"
+        )
+        try:
+            return self._chassis(chassis)
+        finally:
+            lib.lldpctl_atom_dec_ref(chassis)
+
+    def ports(self) -> List[Port]:
+        """Return the local ports and their neighbors."""
+        lib = self._lib
+        ports = []
+        interfaces = self._atom(
+            lib.lldpctl_get_interfaces, self._conn, what="Cannot list the interfaces"
+        )
+        try:
+            for interface in self._values(interfaces):
+                name = self._str(interface, K_INTERFACE_NAME)
+                port = self._atom(
+                    lib.lldpctl_get_port,
+                    interface,
+                    what="Cannot get the port of {}".format(name),
+                )
+                try:
+                    ports.append(
+                        Port(
+                            name,
+                            self._str(port, K_PORT_ID),
+                            self._str(port, K_PORT_DESCR),
+                            self._port_neighbors(name, port),
+                        )
+                    )
+                finally:
+                    lib.lldpctl_atom_dec_ref(port)
+        finally:
+            lib.lldpctl_atom_dec_ref(interfaces)
+        return ports
+
+    def neighbors(self) -> List[Neighbor]:
+        """Return the neighbors seen on every local port."""
+        return [n for port in self.ports() for n in port.neighbors]
+
+    def configure(self, key: str, value: Union[str, int, None]):
+        """Change a setting of the running lldpd, as `lldpcli configure system` does.
+
+        Args:
+            key: one of CONFIG_KEYS
+            value: the new value, or None to unset a string setting
+        """
+        lib = self._lib
+        config = self._atom(
+            lib.lldpctl_get_configuration,
+            self._conn,
+            what="Cannot get the configuration",
+        )
+        try:
+            if isinstance(value, int):
+                result = lib.lldpctl_atom_set_int(config, CONFIG_KEYS[key], value)
+            else:
+                encoded = value.encode() if value is not None else None
+                result = lib.lldpctl_atom_set_str(config, CONFIG_KEYS[key], encoded)
+            if not result:
+                raise self._error("Cannot set {}".format(key))
+        finally:
+            lib.lldpctl_atom_dec_ref(config)
+        logger.debug("Set %s of lldpd to %r", key, value)
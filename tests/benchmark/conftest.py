@@ -0,0 +1,216 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Benchmarks of the charm libraries, run with `tox -e bench`. Every fixture is synthetic
+# and sized like a real machine, and no subprocess is run.
+
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from typing import Callable, List, NamedTuple, Optional
+
+import pytest
+
+# Sizes of the fixtures, which can be overridden to profile bigger machines.
+DPKG_PACKAGES = int(os.environ.get("BENCH_DPKG_PACKAGES", "3000"))
+APT_LIST_MB = int(os.environ.get("BENCH_APT_LIST_MB", "30"))
+SOURCES_ENTRIES = int(os.environ.get("BENCH_SOURCES_ENTRIES", "300"))
+VERSIONS = int(os.environ.get("BENCH_VERSIONS", "20000"))
+
+DESCRIPTION = (
+    "Description: a synthetic package used to size the benchmarks\n"
+    " It has a long description, the way most packages in the archive do, spanning a\n"
+    " few continuation lines which the parsers have to skip over.\n"
+    " .\n"
+    " Package: this-is-not-a-field\n"
+)
+
+
+class Result(NamedTuple):
+    name: str
+    runs: int
+    best: float
+    median: float
+    peak: int
+
+
+RESULTS: List[Result] = []
+
+
+@pytest.fixture
+def measure(request) -> Callable:
+    """Time a callable over several runs and trace its peak memory on one more run.
+
+    The best and median latencies and the peak memory are reported at the end of the
+    session. A budget, in seconds, fails the benchmark when even the best run exceeds it.
+    """
+
+    def _measure(fn: Callable, runs: int = 5, budget: Optional[float] = None) -> Result:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result = Result(
+            request.node.name, runs, min(timings), statistics.median(timings), peak
+        )
+        RESULTS.append(result)
+        if budget is not None:
+            assert result.best <= budget, "{} took {:.3f}s, over its {}s budget".format(
+                result.name, result.best, budget
+            )
+        return result
+
+    return _measure
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(
+        "{:<40} {:>5} {:>12} {:>12} {:>12}".format(
+            "operation", "runs", "best (ms)", "median (ms)", "peak (KiB)"
+        )
+    )
+    for r in RESULTS:
+        terminalreporter.write_line(
+            "{:<40} {:>5} {:>12.3f} {:>12.3f} {:>12.0f}".format(
+                r.name, r.runs, r.best * 1000, r.median * 1000, r.peak / 1024
+            )
+        )
+
+
+def _version(rng: random.Random) -> str:
+    """Return a random version, with epochs, tildes and Debian revisions mixed in."""
+    upstream = ".".join(str(rng.randint(0, 30)) for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.2:
+        upstream += rng.choice(["~rc1", "~beta2", "+dfsg", "+git20240101", "~~"])
+    version = upstream
+    if rng.random() < 0.15:
+        version = "{}:{}".format(rng.randint(1, 3), version)
+    if rng.random() < 0.8:
+        version += "-{}ubuntu{}".format(rng.randint(0, 9), rng.randint(0, 5))
+        if rng.random() < 0.3:
+            version += "~24.04.{}".format(rng.randint(1, 3))
+    return version
+
+
+@pytest.fixture(scope="session")
+def versions() -> List[str]:
+    rng = random.Random(1)
+    return [_version(rng) for _ in range(VERSIONS)]
+
+
+@pytest.fixture(scope="session")
+def package_names() -> List[str]:
+    return [
+        "pkg{:05d}-{}".format(n, "lib" if n % 3 else "utils")
+        for n in range(DPKG_PACKAGES)
+    ]
+
+
+@pytest.fixture(scope="session")
+def dpkg_status(tmp_path_factory, package_names) -> str:
+    """A dpkg status file with `DPKG_PACKAGES` packages, a few of them removed."""
+    rng = random.Random(2)
+    stanzas = []
+    for n, name in enumerate(package_names):
+        status = "deinstall ok config-files" if n % 50 == 0 else "install ok installed"
+        stanzas.append(
+            "Package: {}\nStatus: {}\nPriority: optional\nSection: libs\n"
+            "Installed-Size: {}\nMaintainer: Ubuntu Developers\nArchitecture: {}\n"
+            "Version: {}\nDepends: libc6 (>= 2.34)\n{}".format(
+                name,
+                status,
+                rng.randint(10, 10000),
+                "all" if n % 7 == 0 else "amd64",
+                _version(rng),
+                DESCRIPTION,
+            )
+        )
+    path = tmp_path_factory.mktemp("dpkg") / "status"
+    path.write_text("\n".join(stanzas))
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def apt_lists(tmp_path_factory) -> str:
+    """An apt lists directory with mirror `Packages` files of `APT_LIST_MB` MB in total."""
+    rng = random.Random(3)
+    lists_dir = tmp_path_factory.mktemp("lists")
+    size = APT_LIST_MB * 1024 * 1024
+    for component in ("main", "universe"):
+        stanzas = []
+        written = n = 0
+        while written < size // 2:
+            stanza = (
+                "Package: {}-{}\nArchitecture: amd64\nVersion: {}\nPriority: optional\n"
+                "Section: {}\nOrigin: Ubuntu\nMaintainer: Ubuntu Developers\n"
+                "Installed-Size: {}\nDepends: libc6 (>= 2.34)\n"
+                "Filename: pool/{}/p/pkg/pkg_{}_amd64.deb\nSize: {}\n"
+                "SHA256: {:064x}\n{}".format(
+                    component,
+                    n,
+                    _version(rng),
+                    component,
+                    rng.randint(10, 10000),
+                    component,
+                    n,
+                    rng.randint(1000, 10**7),
+                    rng.getrandbits(256),
+                    DESCRIPTION,
+                )
+            )
+            stanzas.append(stanza)
+            written += len(stanza) + 1
+            n += 1
+        name = "archive.ubuntu.com_ubuntu_dists_noble_{}_binary-amd64_Packages".format(
+            component
+        )
+        (lists_dir / name).write_text("\n".join(stanzas))
+    return str(lists_dir)
+
+
+@pytest.fixture(scope="session")
+def apt_cache_show(apt_lists) -> str:
+    """Recorded `apt-cache show` output for a package found in several lists."""
+    return "\n".join(
+        "Package: main-1000\nArchitecture: amd64\nVersion: 1.{}-1\n{}".format(
+            n, DESCRIPTION
+        )
+        for n in range(20)
+    )
+
+
+@pytest.fixture(scope="session")
+def sources_dir(tmp_path_factory) -> str:
+    """A sources.list.d with `SOURCES_ENTRIES` one-line entries and deb822 stanzas."""
+    parts = tmp_path_factory.mktemp("sources.list.d")
+    per_file = 10
+    for f in range(SOURCES_ENTRIES // per_file):
+        lines = ["# third party repository {}".format(f)]
+        for n in range(per_file):
+            lines.append(
+                "deb [arch=amd64 signed-by=/usr/share/keyrings/r{0}.gpg] "
+                "https://r{0}.example.com/ubuntu noble-{1} main contrib".format(f, n)
+            )
+        (parts / "repo{}.list".format(f)).write_text("\n".join(lines) + "\n")
+    stanzas = []
+    for n in range(SOURCES_ENTRIES // 10):
+        stanzas.append(
+            "Types: deb deb-src\nURIs: http://mirror{}.example.com/ubuntu/\n"
+            "Suites: noble noble-updates noble-backports\n"
+            "Components: main restricted universe multiverse\n"
+            "Signed-By: /usr/share/keyrings/ubuntu-archive-keyring.gpg\n".format(n)
+        )
+    (parts / "mirrors.sources").write_text("\n".join(stanzas))
+    return str(parts)
@@ -0,0 +1,149 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# The budgets are far above the expected timings, they only catch gross regressions.
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+from charms.operator_libs_linux.v0 import apt
+
+
+@pytest.fixture(autouse=True)
+def system_arch():
+    with patch.object(apt, "_get_system_arch", return_value="amd64"):
+        yield
+
+
+def _lists(lists_dir):
+    return apt._AptLists(
+        lists_dir,
+        lambda: [apt._list_prefix("http://archive.ubuntu.com/ubuntu", "noble")],
+    )
+
+
+def test_dpkg_status_parse(measure, dpkg_status, package_names):
+    status = apt._DpkgStatus(dpkg_status, "/nonexistent")
+    measure(status._load, budget=2)
+    assert package_names[1] in status.inventory()
+
+
+def test_dpkg_status_unchanged(measure, dpkg_status):
+    status = apt._DpkgStatus(dpkg_status, "/nonexistent")
+    status.inventory()
+    measure(status.inventory, runs=100, budget=0.01)
+
+
+def test_inventory_diff(measure, dpkg_status):
+    before = apt._DpkgStatus(dpkg_status, "/nonexistent").inventory()
+    after = apt._DpkgStatus(dpkg_status, "/nonexistent").inventory()
+    measure(lambda: before.diff(after), runs=20, budget=0.5)
+
+
+def test_apt_lists_index(measure, apt_lists):
+    measure(lambda: _lists(apt_lists).lookup("main-1000"), budget=5)
+
+
+def test_apt_lists_lookup(measure, apt_lists):
+    lists = _lists(apt_lists)
+    lists.lookup("main-1000")
+    measure(lambda: lists.lookup("universe-2000"), runs=100, budget=0.01)
+
+
+def test_from_apt_cache(measure, apt_lists):
+    with patch.object(apt, "_apt_lists", _lists(apt_lists)):
+        apt.DebianPackage.from_apt_cache("main-1000")
+        measure(
+            lambda: apt.DebianPackage.from_apt_cache("main-1000"), runs=100, budget=0.01
+        )
+
+
+def test_from_apt_cache_show(measure, tmp_path, apt_cache_show):
+    # without uncompressed lists, the recorded `apt-cache show` output is parsed
+    with patch.object(apt, "_apt_lists", _lists(str(tmp_path))), patch.object(
+        apt, "check_output", return_value=apt_cache_show
+    ):
+        result = measure(
+            lambda: apt.DebianPackage.from_apt_cache("main-1000"), runs=100
+        )
+        assert str(apt.DebianPackage.from_apt_cache("main-1000").version) == "1.19-1"
+    assert result.best < 0.05
+
+
+def _mapping(sources_dir, cache):
+    return patch.multiple(
+        apt,
+        APT_SOURCES_LIST=os.path.join(sources_dir, "sources.list"),
+        APT_SOURCES_PARTS=sources_dir,
+        _sources_cache=apt._SourcesCache(str(cache)),
+    )
+
+
+def test_repository_mapping_parse(measure, sources_dir, tmp_path):
+    def _parse():
+        apt._sources_cache.clear()
+        return len(apt.RepositoryMapping())
+
+    with _mapping(sources_dir, tmp_path / "sources.json"):
+        measure(_parse, budget=2)
+        assert _parse() > 0
+
+
+def test_repository_mapping_unchanged(measure, sources_dir, tmp_path):
+    with _mapping(sources_dir, tmp_path / "sources.json"):
+        len(apt.RepositoryMapping())
+        measure(lambda: len(apt.RepositoryMapping()), runs=20, budget=0.1)
+
+
+def test_repository_mapping_next_hook(measure, sources_dir, tmp_path):
+    # a new process reads the files parsed by an earlier hook from the cache on disk
+    cache = str(tmp_path / "sources.json")
+    with _mapping(sources_dir, cache):
+        len(apt.RepositoryMapping())
+
+    def _next_hook():
+        with patch.object(apt, "_sources_cache", apt._SourcesCache(cache)):
+            return len(apt.RepositoryMapping())
+
+    with _mapping(sources_dir, cache):
+        measure(_next_hook, runs=20, budget=0.5)
+        assert _next_hook() > 0
+
+
+def test_repository_line_parse(measure, sources_dir):
+    lines = []
+    for name in sorted(os.listdir(sources_dir)):
+        if name.endswith(".list"):
+            with open(os.path.join(sources_dir, name)) as f:
+                lines.extend(f.read().splitlines())
+
+    def _parse():
+        for line in lines:
+            try:
+                apt.RepositoryMapping._parse(line, "bench.list")
+            except apt.InvalidSourceError:
+                pass
+
+    measure(_parse, budget=1)
+
+
+def test_version_sort(measure, versions):
+    measure(lambda: apt.sort_versions(versions), budget=5)
+
+
+def test_version_compare(measure, versions):
+    parsed = [
+        apt.Version(*reversed(apt.DebianPackage._get_epoch_from_version(v)))
+        for v in versions
+    ]
+    pairs = list(zip(parsed, parsed[1:]))
+    # keys are computed once per version, compare them warm
+    assert all(len(v.sort_key) == 3 for v in parsed)
+
+    def _compare():
+        for a, b in pairs:
+            a < b  # noqa: B015
+
+    measure(_compare, budget=2)
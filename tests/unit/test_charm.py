@@ -3,12 +3,21 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import io
+import socket
+import subprocess
+import tarfile
+import tempfile
 import unittest
 import os
-from unittest.mock import patch, mock_open, MagicMock, PropertyMock
+from unittest.mock import patch, MagicMock, PropertyMock
 
-from charm import LldpdCharm, PACKAGES
+import charm
+from charm import LldpdCharm, APT_UPDATE_MAX_AGE, PACKAGES, platform_name
+from charms.operator_libs_linux.v0 import apt
+from charms.operator_libs_linux.v0.systemd import SystemdError, UnitState
 from ops.testing import Harness
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from pathlib import Path
 
 
@@ -17,6 +26,9 @@ class TestCharm(unittest.TestCase):
         self.harness = Harness(LldpdCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
+        patcher = patch("charm.wait_for_lldpd", return_value=None)
+        self.wait_for_lldpd = patcher.start()
+        self.addCleanup(patcher.stop)
 
     @patch("charm.Path")
     @patch("charm.subprocess.run")
@@ -110,9 +122,131 @@ class TestCharm(unittest.TestCase):
 
     @patch("charm.apt")
     def test_install(self, _apt):
+        _apt.inventory.return_value = {}
         self.harness.charm.on.install.emit()
-        _apt.update.assert_called_once()
-        _apt.add_package.assert_called_once_with(PACKAGES)
+        progress = self.harness.charm.report_progress
+        _apt.update.assert_called_once_with(
+            max_age=APT_UPDATE_MAX_AGE, progress=progress
+        )
+        _apt.add_package.assert_called_once_with(PACKAGES, progress=progress)
+
+    def _add_deb_resource(self, files):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            for name in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name.encode()))
+        self.harness.add_resource("lldpd-debs", buf.getvalue())
+
+    @staticmethod
+    def _deb_fields(path):
+        name, version, _ = os.path.basename(path).split("_")
+        return name, version
+
+    @patch("charm.deb_fields")
+    @patch("charm.platform_name", return_value="ubuntu-22.04-amd64")
+    @patch("charm.apt")
+    def test_install_from_resource(self, _apt, _platform_name, _deb_fields):
+        _apt.inventory.return_value = apt.PackageInventory([], "amd64")
+        _deb_fields.side_effect = self._deb_fields
+        self._add_deb_resource(
+            [
+                "ubuntu-22.04-amd64/lldpd_1.0.13-1_amd64.deb",
+                "ubuntu-22.04-amd64/README",
+                "ubuntu-24.04-amd64/lldpd_1.0.18-1_amd64.deb",
+            ]
+        )
+        self.harness.charm.on.install.emit()
+        debs = _apt.add_deb_files.call_args[0][0]
+        self.assertEqual(
+            [os.path.basename(p) for p in debs], ["lldpd_1.0.13-1_amd64.deb"]
+        )
+        _apt.update.assert_not_called()
+        _apt.add_package.assert_not_called()
+
+    @patch("charm.deb_fields")
+    @patch("charm.platform_name", return_value="ubuntu-22.04-amd64")
+    @patch("charm.apt")
+    def test_install_from_resource_failed(self, _apt, _platform_name, _deb_fields):
+        _apt.PackageError = apt.PackageError
+        _apt.add_deb_files.side_effect = apt.PackageError("Unmet dependencies")
+        # apt reports the resource as installed after all, once it gave up
+        _apt.inventory.side_effect = [
+            apt.PackageInventory([], "amd64"),
+            {p: MagicMock() for p in PACKAGES},
+        ]
+        _deb_fields.side_effect = self._deb_fields
+        self._add_deb_resource(["ubuntu-22.04-amd64/lldpd_1.0.13-1_amd64.deb"])
+        self.harness.charm.on.install.emit()
+        _apt.add_deb_files.assert_called_once()
+        _apt.add_package.assert_not_called()
+
+    @patch("charm.deb_fields")
+    @patch("charm.platform_name", return_value="ubuntu-22.04-amd64")
+    @patch("charm.apt")
+    def test_install_invalid_deb_in_resource(self, _apt, _platform_name, _deb_fields):
+        _apt.inventory.return_value = apt.PackageInventory([], "amd64")
+        _deb_fields.side_effect = subprocess.CalledProcessError(2, "dpkg-deb")
+        self._add_deb_resource(["ubuntu-22.04-amd64/lldpd_1.0.13-1_amd64.deb"])
+        self.harness.charm.on.install.emit()
+        _apt.add_deb_files.assert_not_called()
+        _apt.add_package.assert_called_once()
+
+    @patch("charm.deb_fields")
+    @patch("charm.platform_name", return_value="ubuntu-22.04-amd64")
+    @patch("charm.apt")
+    def test_install_from_resource_already_installed(
+        self, _apt, _platform_name, _deb_fields
+    ):
+        _apt.inventory.return_value = apt.PackageInventory(
+            [apt.InstalledPackage("lldpd", "amd64", "", "1.0.13-1", "installed")],
+            "amd64",
+        )
+        _deb_fields.side_effect = self._deb_fields
+        self._add_deb_resource(["ubuntu-22.04-amd64/lldpd_1.0.13-1_amd64.deb"])
+        self.harness.charm.on.install.emit()
+        _apt.add_deb_files.assert_not_called()
+        _apt.add_package.assert_not_called()
+
+    @patch("charm.platform_name", return_value="ubuntu-20.04-arm64")
+    @patch("charm.apt")
+    def test_install_resource_without_platform(self, _apt, _platform_name):
+        _apt.inventory.return_value = apt.PackageInventory([], "arm64")
+        self._add_deb_resource(["ubuntu-22.04-amd64/lldpd_1.0.13-1_amd64.deb"])
+        self.harness.charm.on.install.emit()
+        _apt.add_deb_files.assert_not_called()
+        _apt.add_package.assert_called_once()
+
+    @patch("charm.apt")
+    def test_install_empty_resource(self, _apt):
+        _apt.inventory.return_value = {}
+        self.harness.add_resource("lldpd-debs", b"")
+        self.harness.charm.on.install.emit()
+        _apt.add_package.assert_called_once()
+
+    def test_platform_name(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write('NAME="Ubuntu"\nVERSION_ID="22.04"\nID=ubuntu\n')
+            f.flush()
+            with patch("charm.OS_RELEASE", f.name):
+                self.assertEqual(platform_name("arm64"), "ubuntu-22.04-arm64")
+
+    def test_report_progress(self):
+        self.harness.charm.report_progress(
+            "Waiting for the apt lock held by apt-get (pid 1)"
+        )
+        self.assertEqual(
+            self.harness.model.unit.status,
+            MaintenanceStatus("Waiting for the apt lock held by apt-get (pid 1)"),
+        )
+
+    @patch("charm.apt")
+    def test_install_already_installed(self, _apt):
+        _apt.inventory.return_value = {p: MagicMock() for p in PACKAGES}
+        self.harness.charm.on.install.emit()
+        _apt.update.assert_not_called()
+        _apt.add_package.assert_not_called()
 
     @patch("charm.LldpdCharm.install")
     def test_upgrade_charm(self, _install):
@@ -133,26 +267,59 @@ class TestCharm(unittest.TestCase):
         self.harness.update_config({"short-name": False})
         _configure.assert_called_once()
 
+    def _patch_paths(self) -> dict:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        paths = {
+            "lldpddef": os.path.join(tmpdir.name, "lldpd.default"),
+            "lldpdconf": os.path.join(tmpdir.name, "lldpd.conf"),
+            "lldpdd": os.path.join(tmpdir.name, "lldpd.d", "charm.conf"),
+            "dropin": os.path.join(tmpdir.name, "lldpd.service.d", "resources.conf"),
+        }
+        patcher = patch.dict("charm.PATHS", paths)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return paths
+
+    def _patch_services(self):
+        """Patch the lldpd restart, systemd reload, and the i40e side effect."""
+        mocks = {}
+        for name in ("daemon_reload", "service_restart"):
+            patcher = patch("charm." + name)
+            mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        mocks["daemon_reload"].return_value = True
+        mocks["service_restart"].return_value = True
+        patcher = patch("charm.lldpcli", return_value=True)
+        mocks["lldpcli"] = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(self.harness.charm, "disable_i40e_lldp")
+        mocks["disable_i40e_lldp"] = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocks
+
+    def _configure(self):
+        """Run configure and commit, as at the end of a dispatch."""
+        self.harness.charm.configure()
+        self.harness.framework.commit()
+
     def _test_configure_helper(self, config: dict, args: str) -> None:
         self.harness.disable_hooks()
         if config:
             self.harness.update_config(config)
 
-        m = mock_open()
-        svc_reload = patch("charm.service_reload").start()
-        disable_i40e = patch.object(self.harness.charm, "disable_i40e_lldp").start()
-        with patch("builtins.open", m):
-            self.harness.charm.configure()
+        paths = self._patch_paths()
+        services = self._patch_services()
+        self._configure()
 
         if self.harness.charm.config["i40e-lldp-stop"]:
-            disable_i40e.assert_called_once()
+            services["disable_i40e_lldp"].assert_called_once()
         else:
-            disable_i40e.assert_not_called()
+            services["disable_i40e_lldp"].assert_not_called()
 
-        m.assert_called_once_with("/etc/default/lldpd", "w")
-        handle = m()
-        handle.write.assert_called_once_with(f'DAEMON_ARGS="{args}"\n')
-        svc_reload.assert_called_once()
+        with open(paths["lldpddef"]) as f:
+            self.assertEqual(f.read(), f'DAEMON_ARGS="{args}"\n')
+        services["service_restart"].assert_called_once_with("lldpd")
 
     def test_configure_defaults(self):
         self._test_configure_helper(dict(), "")
@@ -187,29 +354,332 @@ class TestCharm(unittest.TestCase):
         config = {"enable-snmp": False}
         self._test_configure_helper(config, "")
 
-    @patch("charm.LldpdCharm.update_short_name")
-    def test_configure_enable_short_name(self, _update_short_name):
+    def test_configure_enable_short_name(self):
+        hostname = os.uname()[1]
         with patch(
             "charm.LldpdCharm.machine_id", new_callable=PropertyMock
         ) as mock_property:
             mock_property.return_value = "machine-id"
             config = {"short-name": True}
-            self._test_configure_helper(config, "-S juju_machine_id=machine-id")
-
-            # When there is no JUJU_MACHINE_ID, the defaults
-            # are not updated.
+            self._test_configure_helper(config, "")
+            with open(charm.PATHS["lldpdd"]) as f:
+                self.assertEqual(
+                    f.read(),
+                    "# Managed by the lldpd charm\n"
+                    "configure system description juju_machine_id=machine-id\n"
+                    f"configure system hostname {hostname}\n",
+                )
+
+            # When there is no JUJU_MACHINE_ID, no description is set.
             mock_property.return_value = None
             self._test_configure_helper(config, "")
+            with open(charm.PATHS["lldpdd"]) as f:
+                self.assertNotIn("description", f.read())
 
     def test_configure_multiple_options(self):
         config = {"interfaces-regex": "eth*", "enable-snmp": True}
         self._test_configure_helper(config, "-I eth* -x")
 
-    def test_update_short_name(self):
+    def test_configure_unchanged_skips_reload(self):
+        self.harness.disable_hooks()
+        self._patch_paths()
+        services = self._patch_services()
+        self._configure()
+        services["service_restart"].assert_called_once()
+
+        # nagios options do not change the daemon configuration
+        services["service_restart"].reset_mock()
+        self.harness.update_config({"nagios_context": "other"})
+        self._configure()
+        services["service_restart"].assert_not_called()
+
+        self.harness.update_config({"enable-snmp": True})
+        self._configure()
+        services["service_restart"].assert_called_once()
+
+    def test_configure_reloads_when_not_applied(self):
+        # The file on disk is already up to date, but it was never applied
+        # to the running daemon.
+        self.harness.disable_hooks()
+        paths = self._patch_paths()
+        with open(paths["lldpddef"], "w") as f:
+            f.write('DAEMON_ARGS=""\n')
+        services = self._patch_services()
+        self._configure()
+        services["service_restart"].assert_called_once()
+
+    def test_configure_failed_restart_is_retried(self):
+        self.harness.disable_hooks()
+        self._patch_paths()
+        services = self._patch_services()
+        services["service_restart"].return_value = False
+        self._configure()
+        services["service_restart"].return_value = True
+        self._configure()
+        self.assertEqual(services["service_restart"].call_count, 2)
+        self._configure()
+        self.assertEqual(services["service_restart"].call_count, 2)
+
+    def test_configure_once_per_dispatch(self):
+        # a deferred config-changed runs again before the current one
+        self.harness.disable_hooks()
+        self._patch_paths()
+        services = self._patch_services()
+        self.harness.charm.configure()
+        self.harness.update_config({"enable-snmp": True})
+        self.harness.charm.configure()
+        services["service_restart"].assert_not_called()
+        self.harness.framework.commit()
+        services["service_restart"].assert_called_once_with("lldpd")
+        self.wait_for_lldpd.assert_called_once()
+
+        # nothing was queued by this dispatch
+        self.harness.framework.commit()
+        services["service_restart"].assert_called_once()
+        self.wait_for_lldpd.assert_called_once()
+
+    def test_configure_restart_once(self):
+        self.harness.disable_hooks()
+        self._patch_paths()
+        services = self._patch_services()
+        self._configure()
+        services["service_restart"].reset_mock()
+
+        # several restarts are queued, one applies them all
+        self.harness.charm.queue_restart({"a": "1"})
+        self.harness.charm.queue_restart({"b": "2"})
+        self.harness.framework.commit()
+        services["service_restart"].assert_called_once()
+        self.assertEqual(self.harness.charm.state.applied_fingerprints["a"], "1")
+        self.assertEqual(self.harness.charm.state.applied_fingerprints["b"], "2")
+
+    def test_configure_live_settings(self):
         hostname = os.uname()[1]
-        m = mock_open()
-        with patch("builtins.open", m):
-            self.harness.charm.update_short_name()
-        m.assert_called_once_with("/etc/lldpd.conf", "w")
-        handle = m()
-        handle.write.assert_called_once_with(f"configure system hostname {hostname}\n")
+        self.harness.disable_hooks()
+        paths = self._patch_paths()
+        services = self._patch_services()
+        # the first restart applies the drop-in
+        self.harness.update_config({"short-name": True})
+        self._configure()
+        services["service_restart"].assert_called_once()
+        services["lldpcli"].assert_not_called()
+        self.assertEqual(
+            dict(self.harness.charm.state.applied_settings), {"hostname": hostname}
+        )
+
+        # the settings are changed without restarting lldpd
+        self.harness.update_config({"short-name": False})
+        self._configure()
+        services["service_restart"].assert_called_once()
+        services["lldpcli"].assert_called_once_with(["unconfigure system hostname"])
+        self.assertFalse(os.path.exists(paths["lldpdd"]))
+
+        with patch(
+            "charm.LldpdCharm.machine_id", new_callable=PropertyMock
+        ) as mock_property:
+            mock_property.return_value = "3"
+            self.harness.update_config({"short-name": True})
+            services["lldpcli"].return_value = False
+            self._configure()
+            # a failed session is tried again by the next hook
+            services["lldpcli"].return_value = True
+            self._configure()
+            self._configure()
+        services["service_restart"].assert_called_once()
+        self.assertEqual(services["lldpcli"].call_count, 3)
+        services["lldpcli"].assert_called_with(
+            [
+                "configure system description juju_machine_id=3",
+                f"configure system hostname {hostname}",
+            ]
+        )
+
+    def test_migrate_lldpd_conf(self):
+        self.harness.disable_hooks()
+        paths = self._patch_paths()
+        services = self._patch_services()
+        self._configure()
+        with open(paths["lldpdconf"], "w") as f:
+            f.write("configure system hostname oldname\n")
+        self._configure()
+        self.assertFalse(os.path.exists(paths["lldpdconf"]))
+        services["lldpcli"].assert_called_once_with(["unconfigure system hostname"])
+
+        # a file written by the user is left alone
+        with open(paths["lldpdconf"], "w") as f:
+            f.write("configure lldp tx-interval 10\n")
+        self._configure()
+        self.assertTrue(os.path.exists(paths["lldpdconf"]))
+
+    def test_configure_not_ready(self):
+        self.harness.disable_hooks()
+        self._patch_paths()
+        self._patch_services()
+        self._configure()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus("ready"))
+
+        self.wait_for_lldpd.return_value = "lldpd is failed (failed)"
+        self._configure()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            BlockedStatus("lldpd not ready: lldpd is failed (failed)"),
+        )
+
+    def test_render_resource_controls(self):
+        self.harness.disable_hooks()
+        self.assertEqual(self.harness.charm.render_resource_controls(), "")
+        self.harness.update_config(
+            {
+                "cpu-quota": "20%",
+                "cpu-weight": "50",
+                "memory-max": "64M",
+                "nice": "-5",
+                "io-scheduling-class": "idle",
+                "allowed-cpus": "0-1,6",
+            }
+        )
+        self.assertEqual(
+            self.harness.charm.render_resource_controls(),
+            "# Managed by the lldpd charm\n[Service]\nCPUQuota=20%\nCPUWeight=50\n"
+            "MemoryMax=64M\nNice=-5\nIOSchedulingClass=idle\nAllowedCPUs=0-1,6\n",
+        )
+
+        for option, value in (
+            ("cpu-quota", "20"),
+            ("cpu-weight", "0"),
+            ("memory-max", "64MB"),
+            ("nice", "20"),
+            ("io-scheduling-class", "none"),
+            ("allowed-cpus", "0-1\nNice=-20"),
+        ):
+            self.harness.update_config({option: value})
+            with self.assertRaisesRegex(ValueError, option):
+                self.harness.charm.render_resource_controls()
+            self.harness.update_config(unset=[option])
+
+    def test_configure_resource_controls(self):
+        self.harness.disable_hooks()
+        paths = self._patch_paths()
+        services = self._patch_services()
+        self._configure()
+        services["daemon_reload"].assert_not_called()
+        self.assertFalse(os.path.exists(paths["dropin"]))
+
+        services["service_restart"].reset_mock()
+        self.harness.update_config({"cpu-quota": "20%"})
+        self._configure()
+        with open(paths["dropin"]) as f:
+            self.assertIn("\nCPUQuota=20%\n", f.read())
+        services["daemon_reload"].assert_called_once()
+        services["service_restart"].assert_called_once()
+
+        # unchanged limits are not applied again
+        self._configure()
+        services["daemon_reload"].assert_called_once()
+        services["service_restart"].assert_called_once()
+
+        self.harness.update_config({"cpu-quota": ""})
+        self._configure()
+        self.assertFalse(os.path.exists(paths["dropin"]))
+        self.assertEqual(services["daemon_reload"].call_count, 2)
+        self.assertEqual(services["service_restart"].call_count, 2)
+
+    def test_configure_invalid_resource_controls(self):
+        self.harness.disable_hooks()
+        paths = self._patch_paths()
+        services = self._patch_services()
+        self.harness.update_config({"nice": "lowest"})
+        self._configure()
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("invalid nice: 'lowest'")
+        )
+        self.assertFalse(os.path.exists(paths["lldpddef"]))
+        services["service_restart"].assert_not_called()
+
+    def test_settings_statements(self):
+        self.assertEqual(charm.settings_statements({}, {}), [])
+        self.assertEqual(
+            charm.settings_statements(
+                {"hostname": "node1", "description": "a"}, {"description": "b"}
+            ),
+            ["unconfigure system hostname", "configure system description b"],
+        )
+        self.assertEqual(
+            charm.settings_statements({"hostname": "node1"}, {"hostname": "node1"}), []
+        )
+
+    @patch("charm.subprocess.run")
+    def test_lldpcli(self, _run):
+        self.assertTrue(
+            charm.lldpcli(
+                ["unconfigure system hostname", "configure system hostname a"]
+            )
+        )
+        _run.assert_called_once()
+        self.assertEqual(_run.call_args[0][0], ["lldpcli", "-c", "/dev/stdin"])
+        self.assertEqual(
+            _run.call_args[1]["input"],
+            "unconfigure system hostname\nconfigure system hostname a\n",
+        )
+
+        _run.side_effect = subprocess.CalledProcessError(1, "lldpcli", output="error")
+        self.assertFalse(charm.lldpcli(["configure system hostname a"]))
+        _run.side_effect = FileNotFoundError("lldpcli")
+        self.assertFalse(charm.lldpcli(["configure system hostname a"]))
+
+
+class TestWaitForLldpd(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.socket_path = os.path.join(tmpdir.name, "lldpd.socket")
+        patcher = patch("charm.LLDPD_SOCKET", self.socket_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("charm.service_state")
+        self.service_state = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service_state.return_value = self._state("active", "running")
+
+    @staticmethod
+    def _state(active_state, sub_state, load_state="loaded"):
+        return UnitState("lldpd", load_state, active_state, sub_state, "", False, 0)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(self.socket_path)
+        sock.listen(1)
+
+    def test_ready(self):
+        self._listen()
+        self.assertIsNone(charm.wait_for_lldpd())
+        self.service_state.assert_called_once_with("lldpd", refresh=True)
+
+    def test_converges(self):
+        self.service_state.side_effect = [
+            SystemdError("Failed to connect to bus"),
+            self._state("activating", "start"),
+            self._state("active", "running"),
+            self._state("active", "running"),
+        ]
+        with patch("charm.socket_error", side_effect=["refused", None]), patch(
+            "charm.time.sleep"
+        ) as sleep:
+            self.assertIsNone(charm.wait_for_lldpd())
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(delays, [0.001, 0.002, 0.004])
+
+    def test_failed(self):
+        self.service_state.return_value = self._state("failed", "failed")
+        self.assertEqual(charm.wait_for_lldpd(), "lldpd is failed (failed)")
+        self.service_state.return_value = self._state(
+            "inactive", "dead", load_state="not-found"
+        )
+        self.assertEqual(charm.wait_for_lldpd(), "lldpd unit is not-found")
+
+    def test_timeout(self):
+        reason = charm.wait_for_lldpd(timeout=0.05)
+        self.assertTrue(reason.startswith(self.socket_path), reason)
+        self.assertTrue(reason.endswith("after 0.05s"), reason)
+        self.assertGreater(self.service_state.call_count, 2)
@@ -0,0 +1,237 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import socket
+import tempfile
+import unittest
+
+import lldpctl
+from lldpctl import Chassis, Client, LldpctlError, Neighbor, socket_error
+
+
+class FakeLibrary:
+    """A stand-in for liblldpctl, serving atoms from dicts and counting their references."""
+
+    def __init__(self, interfaces, chassis, config=None):
+        self.interfaces = interfaces
+        self.local_chassis = chassis
+        self.config = config if config is not None else {}
+        self.refs = {}
+        self.values = {}
+        self.socket_path = None
+        self.released = False
+        self.error = None
+
+    def _new(self, value):
+        handle = len(self.values) + 1
+        self.values[handle] = value
+        self.refs[handle] = 1
+        return handle
+
+    def lldpctl_new_name(self, path, send, recv, user_data):
+        self.socket_path = path
+        return 9999
+
+    def lldpctl_release(self, conn):
+        self.released = True
+        return 0
+
+    def lldpctl_last_error(self, conn):
+        return -501
+
+    def lldpctl_strerror(self, code):
+        return b"unable to connect to lldpd daemon"
+
+    def lldpctl_get_interfaces(self, conn):
+        if self.error:
+            return None
+        return self._new(self.interfaces)
+
+    def lldpctl_get_local_chassis(self, conn):
+        return self._new(self.local_chassis)
+
+    def lldpctl_get_configuration(self, conn):
+        return self._new(self.config)
+
+    def lldpctl_get_port(self, interface):
+        return self._new(self.values[interface]["port"])
+
+    def lldpctl_atom_dec_ref(self, atom):
+        assert self.refs[atom] > 0, atom
+        self.refs[atom] -= 1
+
+    def lldpctl_atom_iter(self, atom):
+        return 1 if self.values[atom] else None
+
+    def lldpctl_atom_iter_next(self, atom, it):
+        return it + 1 if it < len(self.values[atom]) else None
+
+    def lldpctl_atom_iter_value(self, atom, it):
+        return self._new(self.values[atom][it - 1])
+
+    def lldpctl_atom_get(self, atom, key):
+        value = self.values[atom].get(key)
+        return self._new(value) if value is not None else None
+
+    def lldpctl_atom_get_str(self, atom, key):
+        value = self.values[atom].get(key)
+        return value.encode() if value is not None else None
+
+    def lldpctl_atom_get_int(self, atom, key):
+        return self.values[atom].get(key, 0)
+
+    def lldpctl_atom_set_str(self, atom, key, value):
+        if self.error:
+            return None
+        self.values[atom][key] = value.decode() if value is not None else None
+        return atom
+
+    def lldpctl_atom_set_int(self, atom, key, value):
+        self.values[atom][key] = value
+        return atom
+
+
+def _port(port_id, descr, neighbors):
+    return {
+        lldpctl.K_PORT_ID: port_id,
+        lldpctl.K_PORT_DESCR: descr,
+        lldpctl.K_PORT_NEIGHBORS: neighbors,
+    }
+
+
+SWITCH = {
+    lldpctl.K_PORT_PROTOCOL: "LLDP",
+    lldpctl.K_PORT_AGE: 42,
+    lldpctl.K_PORT_ID: "Ethernet12",
+    lldpctl.K_PORT_DESCR: "to node1",
+    lldpctl.K_PORT_CHASSIS: {
+        lldpctl.K_CHASSIS_ID: "00:11:22:33:44:55",
+        lldpctl.K_CHASSIS_NAME: "tor1",
+        lldpctl.K_CHASSIS_DESCR: "SONiC",
+    },
+}
+
+
+class SocketTestCase(unittest.TestCase):
+    """A stand-in for the control socket of lldpd, in a temporary directory."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.socket_path = os.path.join(tmpdir.name, "lldpd.socket")
+
+    def _bind(self, listen=True):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(self.socket_path)
+        if listen:
+            sock.listen(1)
+
+
+class TestSocketError(SocketTestCase):
+    def test_listening(self):
+        self._bind()
+        self.assertIsNone(socket_error(self.socket_path))
+
+    def test_missing(self):
+        self.assertEqual(
+            socket_error(self.socket_path),
+            "{}: No such file or directory".format(self.socket_path),
+        )
+
+    def test_refused(self):
+        # lldpd died, leaving its socket behind
+        self._bind(listen=False)
+        self.assertEqual(
+            socket_error(self.socket_path),
+            "{}: Connection refused".format(self.socket_path),
+        )
+
+
+class TestClient(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self._bind()
+        self.lib = FakeLibrary(
+            [
+                {
+                    lldpctl.K_INTERFACE_NAME: "eno1",
+                    "port": _port("aa:bb:cc:dd:ee:01", "eno1", [SWITCH]),
+                },
+                {
+                    lldpctl.K_INTERFACE_NAME: "eno2",
+                    "port": _port("aa:bb:cc:dd:ee:02", "eno2", None),
+                },
+            ],
+            {
+                lldpctl.K_CHASSIS_ID: "aa:bb:cc:dd:ee:01",
+                lldpctl.K_CHASSIS_NAME: "node1.maas",
+            },
+        )
+
+    def assertReleased(self):
+        self.assertEqual(set(self.lib.refs.values()), {0})
+
+    def test_queries(self):
+        with Client(self.socket_path, library=self.lib) as client:
+            self.assertEqual(self.lib.socket_path, self.socket_path.encode())
+            self.assertEqual(
+                client.chassis(), Chassis("aa:bb:cc:dd:ee:01", "node1.maas", "")
+            )
+            ports = client.ports()
+            self.assertEqual([p.interface for p in ports], ["eno1", "eno2"])
+            self.assertEqual(ports[1].port_id, "aa:bb:cc:dd:ee:02")
+            self.assertEqual(ports[1].neighbors, [])
+            self.assertEqual(
+                client.neighbors(),
+                [
+                    Neighbor(
+                        "eno1",
+                        "LLDP",
+                        42,
+                        "00:11:22:33:44:55",
+                        "tor1",
+                        "Ethernet12",
+                        "to node1",
+                    )
+                ],
+            )
+            self.assertFalse(self.lib.released)
+        self.assertTrue(self.lib.released)
+        self.assertReleased()
+
+    def test_configure(self):
+        with Client(self.socket_path, library=self.lib) as client:
+            client.configure("hostname", "node1")
+            client.configure("tx-interval", 10)
+            client.configure("description", None)
+        self.assertEqual(
+            self.lib.config,
+            {
+                lldpctl.CONFIG_KEYS["hostname"]: "node1",
+                lldpctl.CONFIG_KEYS["tx-interval"]: 10,
+                lldpctl.CONFIG_KEYS["description"]: None,
+            },
+        )
+        self.assertReleased()
+
+    def test_errors(self):
+        self.lib.error = True
+        client = Client(self.socket_path, library=self.lib)
+        with self.assertRaisesRegex(LldpctlError, "unable to connect"):
+            client.ports()
+        with self.assertRaisesRegex(LldpctlError, "Cannot set hostname"):
+            client.configure("hostname", "node1")
+        self.assertReleased()
+
+    def test_not_listening(self):
+        missing = os.path.join(os.path.dirname(self.socket_path), "missing.socket")
+        with self.assertRaisesRegex(LldpctlError, "No such file or directory"):
+            Client(missing, library=self.lib)
+        # the library is not asked for a connection which cannot work
+        self.assertIsNone(self.lib.socket_path)
+
+    def test_load_library(self):
+        with self.assertRaises(LldpctlError):
+            lldpctl.load_library("/nonexistent/liblldpctl.so")
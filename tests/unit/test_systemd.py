@@ -0,0 +1,287 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from charms.operator_libs_linux.v0 import systemd
+
+SHOW_OUTPUT = """\
+LoadState=loaded
+ActiveState=active
+SubState=running
+UnitFileState=enabled
+CanReload=yes
+MainPID=1234
+
+LoadState=not-found
+ActiveState=inactive
+SubState=dead
+UnitFileState=
+CanReload=no
+MainPID=0
+"""
+
+
+def _completed(stdout="", returncode=0, stderr=""):
+    return subprocess.CompletedProcess([], returncode, stdout=stdout, stderr=stderr)
+
+
+class SystemdTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.can_reload_cache = os.path.join(tmpdir.name, "can-reload.json")
+        self.boot_id = os.path.join(tmpdir.name, "boot_id")
+        with open(self.boot_id, "w") as f:
+            f.write("boot-1\n")
+        for name, value in (
+            ("CAN_RELOAD_CACHE", self.can_reload_cache),
+            ("BOOT_ID", self.boot_id),
+        ):
+            patcher = patch.object(systemd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(systemd, "_unit_states", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(systemd.subprocess, "run")
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(systemd.subprocess, "Popen")
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        proc = self.popen.return_value
+        proc.communicate.return_value = ("", None)
+        proc.returncode = 0
+
+
+class TestServiceStates(SystemdTestCase):
+    def test_single_query(self):
+        self.run.return_value = _completed(SHOW_OUTPUT)
+        states = systemd.service_states(["lldpd", "snmpd"])
+        self.run.assert_called_once()
+        cmd = self.run.call_args[0][0]
+        self.assertEqual(cmd[:2], ["systemctl", "show"])
+        self.assertEqual(cmd[-2:], ["lldpd", "snmpd"])
+
+        self.assertEqual(
+            states["lldpd"],
+            systemd.UnitState(
+                "lldpd", "loaded", "active", "running", "enabled", True, 1234
+            ),
+        )
+        self.assertTrue(states["lldpd"].running)
+        self.assertTrue(states["lldpd"].enabled)
+        self.assertFalse(states["snmpd"].loaded)
+        self.assertFalse(states["snmpd"].running)
+        self.assertFalse(states["snmpd"].can_reload)
+
+    def test_cached(self):
+        self.run.return_value = _completed(SHOW_OUTPUT)
+        systemd.service_states(["lldpd", "snmpd"])
+        self.assertTrue(systemd.service_running("lldpd"))
+        self.assertEqual(systemd.service_state("snmpd").sub_state, "dead")
+        self.run.assert_called_once()
+
+        systemd.service_state("lldpd", refresh=True)
+        self.assertEqual(self.run.call_count, 2)
+
+    def test_invalidated_by_changes(self):
+        self.run.return_value = _completed(SHOW_OUTPUT)
+        systemd.service_states(["lldpd", "snmpd"])
+        self.assertTrue(systemd.service_restart("lldpd"))
+        self.run.return_value = _completed(SHOW_OUTPUT.split("\n\n")[1])
+        systemd.service_state("snmpd")
+        self.assertEqual(self.run.call_count, 2)
+        self.assertEqual(self.run.call_args[0][0][-1], "snmpd")
+
+    def test_error(self):
+        self.run.return_value = _completed(
+            returncode=1, stderr="Failed to connect to bus"
+        )
+        with self.assertRaises(systemd.SystemdError):
+            systemd.service_state("lldpd")
+        self.assertFalse(systemd.service_running("lldpd"))
+
+
+class TestServicePause(SystemdTestCase):
+    def test_pause(self):
+        self.run.return_value = _completed(SHOW_OUTPUT.split("\n\n")[1])
+        self.assertTrue(systemd.service_pause("snmpd"))
+        self.assertEqual(
+            [c[0][0] for c in self.popen.call_args_list],
+            [
+                ["systemctl", "disable", "snmpd", "--now"],
+                ["systemctl", "mask", "snmpd"],
+            ],
+        )
+        self.run.assert_called_once()
+
+    def test_resume(self):
+        self.run.return_value = _completed(SHOW_OUTPUT.split("\n\n")[0])
+        systemd.service_state("lldpd")
+        self.assertTrue(systemd.service_resume("lldpd"))
+        # the cached state was dropped when the unit changed
+        self.assertEqual(self.run.call_count, 2)
+
+
+class TestServiceReload(SystemdTestCase):
+    LLDPD = SHOW_OUTPUT.split("\n\n")[0]
+
+    def _systemctl_results(self, *returncodes):
+        procs = []
+        for returncode in returncodes:
+            proc = MagicMock(returncode=returncode)
+            proc.communicate.return_value = ("", None)
+            procs.append(proc)
+        self.popen.side_effect = procs
+
+    def _commands(self):
+        return [c[0][0][1] for c in self.popen.call_args_list]
+
+    def test_reload(self):
+        self.run.return_value = _completed(self.LLDPD)
+        self.assertEqual(systemd.service_reload_or_restart("lldpd"), "reload")
+        self.assertEqual(self._commands(), ["reload"])
+
+        # the capability survives the hook
+        systemd._unit_states.clear()
+        self.assertTrue(systemd.service_reload("lldpd", restart_on_failure=True))
+        self.run.assert_called_once()
+
+    def test_cannot_reload(self):
+        self.run.return_value = _completed(
+            self.LLDPD.replace("CanReload=yes", "CanReload=no")
+        )
+        self.assertEqual(systemd.service_reload_or_restart("lldpd"), "restart")
+        self.assertEqual(self._commands(), ["restart"])
+        self.assertFalse(systemd.service_reload("lldpd"))
+        self.assertEqual(self._commands(), ["restart"])
+
+    def test_reload_fails(self):
+        self.run.return_value = _completed(self.LLDPD)
+        self._systemctl_results(1, 0)
+        self.assertEqual(systemd.service_reload_or_restart("lldpd"), "restart")
+        self.assertEqual(self._commands(), ["reload", "restart"])
+
+        self._systemctl_results(1, 1)
+        self.assertIsNone(systemd.service_reload_or_restart("lldpd"))
+
+    def test_forgotten(self):
+        self.run.return_value = _completed(self.LLDPD)
+        systemd.service_reload("lldpd")
+        systemd._unit_states.clear()
+        with open(self.boot_id, "w") as f:
+            f.write("boot-2\n")
+        systemd.service_reload("lldpd")
+        self.assertEqual(self.run.call_count, 2)
+
+        systemd.daemon_reload()
+        self.assertFalse(os.path.exists(self.can_reload_cache))
+
+    def test_unit_file_changed(self):
+        unit_file = os.path.join(os.path.dirname(self.boot_id), "lldpd.service")
+        with open(unit_file, "w") as f:
+            f.write("[Service]\nExecStart=/usr/sbin/lldpd\n")
+        self.run.return_value = _completed(
+            self.LLDPD.replace("CanReload=yes", "CanReload=no")
+            + "\nFragmentPath={}\nDropInPaths=\n".format(unit_file)
+        )
+        self.assertEqual(systemd.service_reload_or_restart("lldpd"), "restart")
+        systemd._unit_states.clear()
+        systemd.service_reload_or_restart("lldpd")
+        self.run.assert_called_once()
+
+        # a package upgrade shipped a unit file which can be reloaded
+        with open(unit_file, "a") as f:
+            f.write("ExecReload=/bin/kill -HUP $MAINPID\n")
+        self.run.return_value = _completed(
+            self.LLDPD + "\nFragmentPath={}\nDropInPaths=\n".format(unit_file)
+        )
+        systemd._unit_states.clear()
+        self.assertEqual(systemd.service_reload_or_restart("lldpd"), "reload")
+        self.assertEqual(self.run.call_count, 2)
+
+    def test_several_units(self):
+        snmpd = SHOW_OUTPUT.split("\n\n")[1].replace(
+            "LoadState=not-found", "LoadState=loaded"
+        )
+        self.run.return_value = _completed(self.LLDPD + "\n\n" + snmpd)
+        self._systemctl_results(0, 0)
+        self.assertTrue(
+            systemd.service_reload(["lldpd", "snmpd"], restart_on_failure=True)
+        )
+        self.assertEqual(
+            [c[0][0] for c in self.popen.call_args_list],
+            [["systemctl", "reload", "lldpd"], ["systemctl", "restart", "snmpd"]],
+        )
+        self.run.assert_called_once()
+
+        self._systemctl_results(1, 0)
+        self.assertFalse(systemd.service_reload(["lldpd", "snmpd"]))
+        self.assertEqual(self._commands()[2:], ["reload"])
+
+
+class TestSeveralUnits(SystemdTestCase):
+    def test_single_call(self):
+        self.assertTrue(systemd.service_restart(["lldpd", "snmpd"]))
+        self.assertTrue(systemd.service_stop(("lldpd", "snmpd")))
+        self.assertEqual(
+            [c[0][0] for c in self.popen.call_args_list],
+            [
+                ["systemctl", "restart", "lldpd", "snmpd"],
+                ["systemctl", "stop", "lldpd", "snmpd"],
+            ],
+        )
+
+    def test_running(self):
+        self.run.return_value = _completed(SHOW_OUTPUT)
+        self.assertFalse(systemd.service_running(["lldpd", "snmpd"]))
+        self.assertTrue(systemd.service_running(["lldpd"]))
+        self.run.assert_called_once()
+
+    def test_output(self):
+        self.popen.return_value.communicate.return_value = ("unit not found\n", None)
+        self.popen.return_value.returncode = 5
+        with self.assertLogs(systemd.logger, "DEBUG") as logs:
+            self.assertFalse(systemd.service_start("snmpd"))
+        self.assertIn("DEBUG:{}:unit not found".format(systemd.__name__), logs.output)
+        self.popen.return_value.communicate.assert_called_once_with(timeout=None)
+
+
+class TestServiceJob(SystemdTestCase):
+    def test_background(self):
+        self.run.return_value = _completed(SHOW_OUTPUT)
+        systemd.service_states(["lldpd", "snmpd"])
+        proc = self.popen.return_value
+        proc.poll.return_value = None
+
+        job = systemd.service_job("restart", ["lldpd", "snmpd"])
+        self.assertEqual(job.cmd, ["systemctl", "restart", "lldpd", "snmpd"])
+        self.assertFalse(job.done)
+        proc.communicate.assert_not_called()
+        # the units are changing, their cached state is dropped
+        self.assertEqual(systemd._unit_states, {})
+
+        proc.poll.return_value = 0
+        self.assertTrue(job.done)
+        self.assertTrue(job.wait())
+        self.assertTrue(job.wait())
+        proc.communicate.assert_called_once()
+
+    def test_timeout(self):
+        proc = self.popen.return_value
+        proc.communicate.side_effect = [
+            subprocess.TimeoutExpired(["systemctl"], 1),
+            ("", None),
+        ]
+        proc.returncode = 1
+        job = systemd.service_job("restart", "lldpd")
+        with self.assertRaises(subprocess.TimeoutExpired):
+            job.wait(timeout=1)
+        self.assertFalse(job.wait())
+        self.assertEqual(job.returncode, 1)